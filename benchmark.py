@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+""" Measure how the data handling scales with the size of the collection
+
+Each benchmark runs one operation over a whole data dir (a synthetic one from
+``generate.py`` by default) and reports its wall time, its throughput in
+pieces per second, and its peak Python memory (from ``tracemalloc``, measured
+in a second run so it doesn't slow down the timed one).  The memory held by a
+fully loaded catalog is reported too, per piece.
+
+Results are written as JSON, by default to ``CACHE_DIR/benchmarks/`` named
+after the current git commit.  Pass an older result file to ``--compare`` to
+see how each operation changed.  Everything runs offline, and always against
+JSON data files in a temporary directory, so the real collection (and its
+database, with ``CURRENCY_BACKEND=sqlite``) is never read or written.
+
+``total.py`` has to start quickly, so the benchmark exits with a non-zero
+status when its startup time, or that of ``currency.py total``, is over
+`STARTUP_BUDGET`.  That makes it usable as a regression check.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cache
+import constants
+import generate
+import models
+import query
+import total
+
+# total.py must start, load one country and print in this long.  Before any
+# caching or lazy imports it took 0.040s for canada, so this is 1.5 times
+# that.
+STARTUP_BUDGET = 0.06
+# The startup benchmarks, and the command line each one times
+STARTUP_COMMANDS = [
+    ("startup (total.py)", ("total.py",)),
+    ("startup (currency.py total)", ("currency.py", "total")),
+]
+# Startup is timed this many times and the fastest run counts, so that one
+# slow run on a busy machine doesn't fail the benchmark
+STARTUP_RUNS = 5
+
+
+def parse_args(argv=None):
+    description = "Benchmark loading, validating, saving and totalling"
+    argparser = argparse.ArgumentParser(description=description)
+    argparser.add_argument("--data",
+                           type=str,
+                           required=False,
+                           default='',
+                           help=("Benchmark an existing data dir instead of "
+                                 "generating one.  It is not modified."))
+    argparser.add_argument("--countries",
+                           "-c",
+                           type=int,
+                           required=False,
+                           default=200,
+                           help="Number of countries to generate.")
+    argparser.add_argument("--pieces",
+                           "-p",
+                           type=int,
+                           required=False,
+                           default=100000,
+                           help="Number of pieces to generate.")
+    argparser.add_argument("--depth",
+                           "-d",
+                           type=int,
+                           required=False,
+                           default=4,
+                           help="Longest subunit chain to generate.")
+    argparser.add_argument("--output",
+                           "-o",
+                           type=str,
+                           required=False,
+                           default='',
+                           help="File to write the results to.")
+    argparser.add_argument("--compare",
+                           type=str,
+                           required=False,
+                           default='',
+                           help="Earlier results file to compare against.")
+    argparser.add_argument("--no-memory",
+                           required=False,
+                           default=False,
+                           action="store_true",
+                           help="Skip the peak memory measurements.")
+    return argparser.parse_args(argv)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def measure(operation, memory=True):
+    """ Run an operation and return (seconds, peak bytes or None) """
+    start = time.perf_counter()
+    operation()
+    seconds = time.perf_counter() - start
+    peak = None
+    if memory:
+        tracemalloc.start()
+        operation()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return seconds, peak
+
+
+def clear_caches():
+    shutil.rmtree(constants.CACHE_DIR, ignore_errors=True)
+    cache.COUNTRIES.clear()
+    cache.TOTALS.clear()
+
+
+def catalog_memory():
+    """ Bytes of Python memory held by every country, once loaded """
+    # Make sure the on-disk cache is warm so only the loaded models are left
+    # in memory afterwards
+    models.Country.load_all()
+    tracemalloc.start()
+    countries = models.Country.load_all()
+    resident, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del countries
+    return resident
+
+
+def measure_startup(*args):
+    """ Time a script in a fresh interpreter, at its fastest
+
+    :param args:  The script's file name and its arguments
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          args[0])
+    command = [sys.executable, script] + list(args[1:])
+    # Warm up the on-disk cache first, like any run after the first one
+    subprocess.check_call(command, stdout=subprocess.DEVNULL)
+    fastest = None
+    for _ in range(STARTUP_RUNS):
+        start = time.perf_counter()
+        subprocess.check_call(command, stdout=subprocess.DEVNULL)
+        seconds = time.perf_counter() - start
+        if fastest is None or seconds < fastest:
+            fastest = seconds
+    return fastest
+
+
+def run_benchmarks(memory=True):
+    """ Run every benchmark against constants.COUNTRY_DIR
+
+    :returns:  A dict mapping benchmark names to their results
+    """
+    # map only imports cartopy and matplotlib when it draws
+    import map as world_map
+
+    clear_caches()
+    countries = models.Country.load_all()
+    num_pieces = sum(len(c.inventory) for c in countries)
+
+    def cold_load():
+        clear_caches()
+        models.Country.load_all()
+
+    def save_all():
+        # save() skips a country that hasn't changed, so add a piece to each
+        # one first.  Otherwise this would only time the comparison.
+        for country in countries:
+            if country.inventory:
+                country.inventory.append(country.inventory[0])
+            country.save()
+
+    def total_each():
+        for country in countries:
+            for denomination in country.denominations:
+                total.total(country, denomination)
+
+    def format_all():
+        batch = total.total_all(countries)
+        for country in countries:
+            total.format_country(country, verbose=True, totals=batch)
+
+    def query_all():
+        index = query.Index(countries)
+        rows = index.select(piece_type='coin', obsolete=False)
+        index.aggregate(rows, ['country', 'denomination'])
+
+    benchmarks = [
+        ("load_all (cold cache)", cold_load),
+        ("load_all (warm cache)", models.Country.load_all),
+        ("validate", lambda: [c.validate() for c in countries]),
+        ("total (per denomination)", total_each),
+        ("total_all", lambda: total.total_all(countries)),
+        ("format_country --verbose", format_all),
+        ("map.load_countries", world_map.load_countries),
+        ("query (index + group by)", query_all),
+        # Saving invalidates the cache, so this goes last
+        ("save", save_all),
+    ]
+    results = {}
+    for name, operation in benchmarks:
+        seconds, peak = measure(operation, memory)
+        results[name] = dict(seconds=seconds,
+                             pieces_per_second=num_pieces / seconds
+                             if seconds else None,
+                             peak_bytes=peak)
+        print("%-28s %9.4fs %14s pieces/s %12s" %
+              (name, seconds,
+               "%.0f" % results[name]['pieces_per_second']
+               if seconds else '-',
+               "%.1f MiB" % (peak / 2.0 ** 20) if peak else ''))
+
+    # Time the command lines people actually type, which ask the daemon
+    # first.  There isn't one running for the benchmark's data.
+    smallest = min(countries, key=lambda c: len(c.inventory)).short_name
+    for name, command in STARTUP_COMMANDS:
+        startup = measure_startup(*command + (smallest,))
+        results[name] = dict(seconds=startup, pieces_per_second=None,
+                             peak_bytes=None)
+        print("%-28s %9.4fs%s" % (name, startup,
+                                  "  OVER BUDGET" if startup > STARTUP_BUDGET
+                                  else ''))
+    if memory:
+        resident = catalog_memory()
+        results["catalog memory"] = dict(seconds=None,
+                                         pieces_per_second=None,
+                                         peak_bytes=resident)
+        print("%-28s %9.1f MiB %9.0f bytes/piece" %
+              ("catalog memory", resident / 2.0 ** 20,
+               resident / num_pieces if num_pieces else 0))
+    return dict(countries=len(countries), pieces=num_pieces,
+                results=results)
+
+
+def compare(old, new):
+    """ Print how each benchmark changed between two result files """
+    print("\n%-28s %10s %10s %8s" % ("compared to " + old['commit'],
+                                     "before", "after", "change"))
+    for name, result in new['results'].items():
+        before = old['results'].get(name)
+        if not before:
+            continue
+        if result['seconds'] is None:
+            if before['peak_bytes'] and result['peak_bytes']:
+                change = result['peak_bytes'] / before['peak_bytes'] - 1
+                print("%-28s %8.1fMiB %8.1fMiB %+7.1f%%" %
+                      (name, before['peak_bytes'] / 2.0 ** 20,
+                       result['peak_bytes'] / 2.0 ** 20, change * 100))
+            continue
+        change = result['seconds'] / before['seconds'] - 1
+        print("%-28s %9.4fs %9.4fs %+7.1f%%" %
+              (name, before['seconds'], result['seconds'], change * 100))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix="currency-benchmark-")
+    cache_dir = constants.CACHE_DIR
+    backend = constants.STORAGE_BACKEND
+    try:
+        data_dir = os.path.join(workdir, "data")
+        if args.data:
+            # save() writes, so benchmark a copy
+            shutil.copytree(args.data, data_dir)
+        else:
+            print("Generating %d countries with %d pieces" %
+                  (args.countries, args.pieces))
+            generate.generate(data_dir, args.countries, args.pieces,
+                              args.depth)
+        # Child processes (the startup benchmark) must see the same dirs
+        os.environ['CURRENCY_COUNTRY_DIR'] = data_dir
+        os.environ['CURRENCY_CACHE_DIR'] = os.path.join(workdir, "cache")
+        os.environ['CURRENCY_BACKEND'] = 'json'
+        constants.COUNTRY_DIR = os.environ['CURRENCY_COUNTRY_DIR']
+        constants.CACHE_DIR = os.environ['CURRENCY_CACHE_DIR']
+        constants.STORAGE_BACKEND = os.environ['CURRENCY_BACKEND']
+        results = run_benchmarks(memory=not args.no_memory)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        constants.CACHE_DIR = cache_dir
+        constants.STORAGE_BACKEND = backend
+
+    results.update(commit=git_commit(),
+                   date=time.strftime("%Y-%m-%dT%H:%M:%S"),
+                   python=sys.version.split()[0])
+    output = args.output or os.path.join(
+        constants.CACHE_DIR, "benchmarks", "%s.json" % results['commit'])
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as output_file:
+        json.dump(results, output_file, indent=4, sort_keys=True)
+    print("\nWrote %s" % output)
+
+    if args.compare:
+        with open(args.compare, 'r') as compare_file:
+            compare(json.load(compare_file), results)
+
+    for name, _ in STARTUP_COMMANDS:
+        startup = results['results'][name]['seconds']
+        if startup > STARTUP_BUDGET:
+            sys.exit("benchmark.py:  %s took %.3fs, over the budget of "
+                     "%.3fs" % (name, startup, STARTUP_BUDGET))
+
+
+if __name__ == "__main__":
+    main()
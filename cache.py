@@ -0,0 +1,213 @@
+""" On-disk cache of parsed country data
+
+Parsing every data file and rebuilding all of the model objects is the
+slowest part of starting any of the scripts, even though the data files rarely
+change between runs.  This module keeps a pickled copy of each parsed
+`models.Country` under ``constants.CACHE_DIR`` and only re-parses a data file
+when it has changed.
+
+Each cache entry records the data file's mtime, size, and a SHA-1 of its
+contents.  If the mtime and size match, the cached country is used without
+reading the data file at all.  If they don't, the file is read and hashed, and
+the cached country is still used if the contents turn out to be identical
+(e.g. after a ``touch`` or a ``git checkout``).
+
+The cache directory is named after the absolute path of
+``constants.COUNTRY_DIR`` so that pointing the scripts at a different data dir
+never mixes countries.
+
+This module also holds the in-memory caches that live for one process:
+``COUNTRIES`` holds countries loaded with `models.Country.load_cached`, and
+``TOTALS`` holds their totals.  Both are bounded LRU caches, and saving a
+country drops it from every cache.
+"""
+import collections
+import os
+import pickle
+
+import constants
+import profiling
+
+# Bump this whenever the pickled models change shape
+CACHE_VERSION = 9
+# The kinds of entry kept for each country.  '' is the country as parsed, and
+# 'columnar' is the country with an `inventory.ColumnarInventory`.
+VARIANTS = ('', 'columnar')
+
+
+class LRUCache(object):
+    """ A dict-like cache that holds at most `maxsize` entries
+
+    When it's full, adding an entry evicts the least recently used one.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            self._entries.move_to_end(key)
+        except KeyError:
+            return default
+        return self._entries[key]
+
+    def put(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+COUNTRIES = LRUCache(constants.COUNTRY_CACHE_SIZE)
+TOTALS = LRUCache(constants.COUNTRY_CACHE_SIZE)
+
+
+def catalog_dir():
+    """ Directory holding everything cached for the current COUNTRY_DIR
+
+    It's named after the path itself, escaped, rather than a hash of it, so
+    that a warm load doesn't have to import hashlib.  Paths too long to be a
+    file name are hashed after all.
+    """
+    country_dir = os.path.abspath(constants.COUNTRY_DIR)
+    name = country_dir.replace('%', '%25').replace(os.sep, '%2F')
+    if len(name.encode('utf-8')) > 200:
+        import hashlib
+
+        name = hashlib.sha1(country_dir.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(constants.CACHE_DIR, 'catalog', name)
+
+
+def _entry_path(short_name, variant=''):
+    if variant:
+        short_name = "%s.%s" % (short_name, variant)
+    return os.path.join(catalog_dir(), "%s.pickle" % short_name)
+
+
+def _read_entry(short_name, variant=''):
+    """ Return the cache entry for a country, or None if it's missing or bad
+    """
+    try:
+        with profiling.span("cache read"):
+            with open(_entry_path(short_name, variant), 'rb') as cache_file:
+                entry = pickle.load(cache_file)
+    except Exception:  # pylint: disable=W0703
+        # A missing, truncated, or stale cache file is just a cache miss
+        return None
+    if not isinstance(entry, dict) or entry.get('version') != CACHE_VERSION:
+        return None
+    return entry
+
+
+def _write_entry(short_name, entry, variant=''):
+    path = _entry_path(short_name, variant)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file and rename it into place so that a reader
+        # never sees a partially written pickle
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, 'wb') as cache_file:
+            pickle.dump(entry, cache_file, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except OSError:
+        # The cache is an optimization.  A read-only checkout still works.
+        pass
+
+
+def _stat_key(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def _read_optional(path):
+    try:
+        with open(path, 'rb') as optional_file:
+            return optional_file.read()
+    except FileNotFoundError:
+        return None
+
+
+def content_digest(json_data, journal_data=None):
+    """ Hash the contents of a country's data file and journal """
+    import hashlib
+
+    digest = hashlib.sha1(json_data)
+    if journal_data:
+        digest.update(b'\0')
+        digest.update(journal_data)
+    return digest.hexdigest()
+
+
+def file_digest(path, journal_path=None):
+    """ `content_digest` of a country's files on disk """
+    with open(path, 'rb') as json_file:
+        json_data = json_file.read()
+    journal_data = _read_optional(journal_path) if journal_path else None
+    return content_digest(json_data, journal_data)
+
+
+def load_country(short_name, path, parse, journal_path=None, variant=''):
+    """ Load a country, reusing the cached copy if the data file is unchanged
+
+    :param short_name:  The country's short name
+    :param path:  Path to the country's data file
+    :param parse:  A callable that turns the data file's bytes and the
+                   journal's bytes (or None) into a `models.Country`
+    :param journal_path:  Path to the country's insert journal, if any.  It's
+                          part of the cache key, just like the data file.
+    :param variant:  Which of the `VARIANTS` ``parse`` builds.  Each one is
+                     cached separately.
+    :returns:  A `models.Country`
+    """
+    stat = os.stat(path)
+    stat_key = ((stat.st_mtime_ns, stat.st_size),
+                _stat_key(journal_path) if journal_path else None)
+    entry = _read_entry(short_name, variant)
+    if entry is not None and entry['stat'] == stat_key:
+        profiling.count("cache.hit")
+        return entry['country']
+
+    with open(path, 'rb') as json_file:
+        json_data = json_file.read()
+    journal_data = _read_optional(journal_path) if journal_path else None
+    digest = content_digest(json_data, journal_data)
+    if entry is not None and entry['digest'] == digest:
+        profiling.count("cache.hit (same contents)")
+        country = entry['country']
+    else:
+        profiling.count("cache.miss")
+        country = parse(json_data, journal_data)
+    _write_entry(short_name, dict(version=CACHE_VERSION,
+                                  stat=stat_key,
+                                  digest=digest,
+                                  country=country), variant)
+    return country
+
+
+def invalidate(short_name):
+    """ Drop every cached copy of a country.  Called whenever a country is
+    saved.
+    """
+    COUNTRIES.invalidate(short_name)
+    TOTALS.invalidate(short_name)
+    for variant in VARIANTS:
+        try:
+            os.remove(_entry_path(short_name, variant))
+        except OSError:
+            pass
@@ -0,0 +1,110 @@
+""" Every country and its totals, kept in memory and reloaded as it changes
+
+Long-running tools (``server.py``, and ``total.py`` and ``map.py`` with
+``--watch``) keep a `Catalog` and call `Catalog.reload` with whatever
+``watch.wait_for_changes`` reports, instead of loading everything again.
+Watchers can lag behind a write, so anything that has to be current (like
+``server.py`` answering a request) calls `Catalog.refresh` first.
+"""
+import sys
+import threading
+
+import cache
+import models
+import query
+import total
+
+
+class Catalog(object):
+    """ Every country and all of their totals, kept in memory """
+
+    def __init__(self):
+        self.countries = {}
+        self.totals = {}
+        # Short name -> `models.Country.stamp` of what's loaded
+        self.stamps = {}
+        self._index = None
+        self._index_lock = threading.Lock()
+        self._reload_lock = threading.RLock()
+        self.reload(models.Country.list_all())
+
+    @property
+    def index(self):
+        """ A `query.Index` of every piece, built on first use """
+        with self._index_lock:
+            if self._index is None:
+                self._index = query.Index(self.countries.values())
+            return self._index
+
+    def collection(self):
+        """ The catalog in the form of `map.load_collection` """
+        return list(self.countries.values()), self.totals
+
+    def refresh(self, short_names=None):
+        """ Reload whichever countries changed since they were loaded
+
+        This only looks at each country's `models.Country.stamp`, so it's
+        cheap enough to do before every request.
+
+        :param short_names:  The countries to check.  Defaults to every
+                             country, including new ones.
+        """
+        if short_names is None:
+            short_names = set(models.Country.list_all()) | set(self.stamps)
+        changed = [short_name for short_name in short_names
+                   if _stamp(short_name) != self.stamps.get(short_name)]
+        if changed:
+            self.reload(changed)
+
+    def reload(self, short_names):
+        """ Reload some countries after their files changed
+
+        Only the named countries are loaded again and have their totals
+        recomputed.  The new state is built on the side and swapped in, so
+        other threads always see a consistent catalog.  A country that can't
+        be loaded is reported and left out until its files change again.
+        """
+        with self._reload_lock:
+            countries = dict(self.countries)
+            totals = dict(self.totals)
+            stamps = dict(self.stamps)
+            for short_name in short_names:
+                # The on-disk cache checks for changes itself
+                cache.COUNTRIES.invalidate(short_name)
+                cache.TOTALS.invalidate(short_name)
+                old = countries.pop(short_name, None)
+                if old is not None:
+                    for key in [k for k in totals if k[0] == short_name]:
+                        del totals[key]
+                # Take the stamp first, so that a change made while loading
+                # gets noticed next time
+                stamp = stamps[short_name] = _stamp(short_name)
+                if stamp is None:
+                    # Deleted
+                    del stamps[short_name]
+                    continue
+                try:
+                    country = models.Country.load(short_name)
+                    country_totals = total.total_all([country])
+                except SystemExit:
+                    # Deleted since it was stamped
+                    continue
+                except Exception as e:  # pylint: disable=W0703
+                    # Probably caught halfway through a hand edit
+                    print("Could not load %s:  %s: %s" %
+                          (short_name, type(e).__name__, e), file=sys.stderr)
+                    continue
+                countries[short_name] = country
+                totals.update(country_totals)
+            with self._index_lock:
+                self.countries, self.totals = countries, totals
+                self.stamps = stamps
+                self._index = None
+
+
+def _stamp(short_name):
+    """ `models.Country.stamp`, or None if the country doesn't exist """
+    try:
+        return models.Country.stamp(short_name)
+    except (OSError, KeyError):
+        return None
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+""" Fold insert journals back into the country data files
+
+``insert.py`` appends new pieces to a hidden per-country journal instead of
+rewriting the country's data file.  This script loads each country (which
+replays its journal), saves it, and so removes the journal.
+"""
+import argparse
+import os
+
+import constants
+import models
+
+
+def parse_args(argv=None):
+    description = "Fold insert journals into the country data files"
+    argparser = argparse.ArgumentParser(description=description)
+    argparser.add_argument("countries",
+                           type=str,
+                           nargs='*',
+                           help=("Countries to compact.  Defaults to every "
+                                 "country with a journal."))
+    return argparser.parse_args(argv)
+
+
+def journaled_countries():
+    """ List the short names of every country that has a journal """
+    short_names = []
+    for filename in sorted(os.listdir(constants.COUNTRY_DIR)):
+        if filename.startswith('.') and filename.endswith('.journal'):
+            short_names.append(filename[1:-len('.journal')])
+    return short_names
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    for short_name in args.countries or journaled_countries():
+        print("Compacting {}".format(short_name))
+        with models.Country.edit(short_name):
+            pass
+
+
+if __name__ == "__main__":
+    main()
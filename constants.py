@@ -1,7 +1,34 @@
 import os
 
 DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
-COUNTRY_DIR = DATA_DIR
+# Both of these can be pointed elsewhere, e.g. at generated benchmark data
+COUNTRY_DIR = os.environ.get('CURRENCY_COUNTRY_DIR', DATA_DIR)
+# Parsed data and other derived files.  Safe to delete at any time.
+CACHE_DIR = os.environ.get('CURRENCY_CACHE_DIR',
+                           os.path.join(os.path.dirname(__file__), '.cache'))
+# Where countries are stored:  "json" for one data file per country in
+# COUNTRY_DIR, or "sqlite" for the database at SQLITE_PATH.  See storage.py.
+STORAGE_BACKEND = os.environ.get('CURRENCY_BACKEND', 'json')
+SQLITE_PATH = os.environ.get(
+    'CURRENCY_SQLITE_PATH',
+    os.path.join(os.path.dirname(__file__), 'collection.sqlite3'))
+# Exchange rates and redenominations for valuation.py.  Neither is part of the
+# collection, so they're kept out of DATA_DIR.
+RATES_PATH = os.environ.get(
+    'CURRENCY_RATES_PATH',
+    os.path.join(os.path.dirname(__file__), 'rates.csv'))
+REDENOMINATIONS_PATH = os.environ.get(
+    'CURRENCY_REDENOMINATIONS_PATH',
+    os.path.join(os.path.dirname(__file__), 'redenominations.csv'))
+# How many parsed countries (and their totals) one process keeps in memory
+COUNTRY_CACHE_SIZE = 32
+# Where server.py listens by default, and how long clients wait for it to
+# answer
+DAEMON_PORT = int(os.environ.get('CURRENCY_DAEMON_PORT', 8417))
+DAEMON_TIMEOUT = 2.0
+# While server.py runs, it writes its pid and port here.  Clients only try to
+# connect if it's there.
+DAEMON_FILE = os.path.join(CACHE_DIR, 'server.pid')
 EUROZONE_COUNTRIES = set([
     "Austria",
     "Belgium",
@@ -38,3 +65,11 @@ COMMON_MONETARY_AREA_COUNTRIES = set([
     "Kingdom of eSwatini",
     "Lesotho",
 ])
+# Monetary unions whose members share one currency.  Each entry is the name
+# to print, the short name of the country file holding the shared currency,
+# and the long names of the member countries.
+SHARED_CURRENCY_UNIONS = [
+    ("Eurozone", "eurozone", EUROZONE_COUNTRIES),
+    ("CEMAC", "cemac", CEMAC_COUNTRIES),
+    ("Common Monetary Area", "south-africa", COMMON_MONETARY_AREA_COUNTRIES),
+]
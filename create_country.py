@@ -1,13 +1,11 @@
 #!/usr/bin/env python3
 import argparse
-import os
 import sys
 
-import constants
 import models
 
 
-def parse_args():
+def parse_args(argv=None):
     description = ("Add a new country to the collection, creating all the "
                    "metadata.")
     argparser = argparse.ArgumentParser(description=description)
@@ -16,7 +14,7 @@ def parse_args():
                            nargs='?',
                            default='',
                            help="Short name of country")
-    args = argparser.parse_args()
+    args = argparser.parse_args(argv)
     return args
 
 
@@ -97,12 +95,11 @@ def read_input(short_name):
     country.save()
 
 
-def main():
-    args = parse_args()
+def main(argv=None):
+    args = parse_args(argv)
     short_name = args.short_name or raw_input("Country name (short):  ")
 
-    path = os.path.join(constants.COUNTRY_DIR, short_name + ".json")
-    if os.path.exists(path):
+    if models.Country.exists(short_name):
         print("Country %s already exists!", short_name)
         sys.exit(1)
 
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+""" One command for every script:  ``currency.py <subcommand> [args]``
+
+Each subcommand is one of the scripts in this directory, and takes the same
+arguments it does.  ``currency.py --profile <subcommand> ...`` turns on the
+timing spans in ``profiling`` for any subcommand.  Only the module for the
+chosen subcommand is imported, so ``currency.py total canada`` never pays for
+cartopy or matplotlib.
+"""
+import importlib
+import sys
+
+# Subcommand name -> (module, description)
+COMMANDS = {
+    "total": ("total", "Print totals for one or all countries"),
+    "insert": ("insert", "Add pieces to the collection"),
+    "validate": ("validate", "Validate all country data"),
+    "map": ("map", "Draw the map of countries I have currency for"),
+    "create-country": ("create_country", "Add a new country"),
+    "compact": ("compact", "Fold insert journals into the data files"),
+    "serve": ("server", "Serve totals from memory over localhost HTTP"),
+    "query": ("query", "Filter and summarize pieces across countries"),
+    "value": ("valuation", "Value the collection with local exchange rates"),
+    "db": ("storage", "Copy countries between data files and SQLite"),
+}
+
+
+def usage():
+    lines = ["usage: currency.py [--profile] <subcommand> [args]", "",
+             "subcommands:"]
+    for name, (_, description) in COMMANDS.items():
+        lines.append("  %-16s %s" % (name, description))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == "--profile":
+        import profiling
+        profiling.enable()
+        argv = argv[1:]
+    if not argv or argv[0] in ("-h", "--help"):
+        print(usage())
+        return
+    if argv[0] not in COMMANDS:
+        print(usage(), file=sys.stderr)
+        print("\ncurrency.py: unknown subcommand '%s'" % argv[0],
+              file=sys.stderr)
+        sys.exit(2)
+    module_name, _ = COMMANDS[argv[0]]
+    # Make argparse name the subcommand in its usage messages
+    sys.argv[0] = "currency.py %s" % argv[0]
+    importlib.import_module(module_name).main(argv[1:])
+
+
+if __name__ == "__main__":
+    main()
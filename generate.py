@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+""" Generate a synthetic country data dir for benchmarking
+
+The generated countries look like the real ones, only bigger:  several
+denominations each, subunit chains as deep as pre-decimal Australia's (or
+deeper), a mix of obsolete and current pieces, and a handful of owners.
+Every country is written with `models.Country.save`, so all of them pass
+`models.Country.validate`.  The countries are always written as JSON data
+files, whatever ``CURRENCY_BACKEND`` says, so generating never touches the
+real collection's database.
+
+Nothing here needs a network connection.
+"""
+import argparse
+import os
+import random
+
+import constants
+import models
+
+OWNERS = ["Joel Friedly", "Kay Friedly", "Dan Faber", "Someone Else"]
+# How many of the next smaller unit fit in a unit
+DIVISIONS = [2, 4, 10, 12, 20, 100]
+
+
+def parse_args(argv=None):
+    description = "Generate a synthetic country data dir for benchmarking"
+    argparser = argparse.ArgumentParser(description=description)
+    argparser.add_argument("directory",
+                           type=str,
+                           help="Directory to write the countries to.")
+    argparser.add_argument("--countries",
+                           "-c",
+                           type=int,
+                           required=False,
+                           default=200,
+                           help="Number of countries to generate.")
+    argparser.add_argument("--pieces",
+                           "-p",
+                           type=int,
+                           required=False,
+                           default=100000,
+                           help="Total number of pieces across all countries.")
+    argparser.add_argument("--depth",
+                           "-d",
+                           type=int,
+                           required=False,
+                           default=4,
+                           help="Longest subunit chain to generate.")
+    argparser.add_argument("--seed",
+                           type=int,
+                           required=False,
+                           default=0,
+                           help="Random seed, for repeatable data.")
+    return argparser.parse_args(argv)
+
+
+def make_denomination(rng, index, depth, obsolete):
+    """ Build a Denomination with a subunit chain of up to `depth` units """
+    num_subunits = rng.randint(1, depth)
+    subunits = ["units%d" % i for i in range(num_subunits)]
+    divisions = {subunits[-1]: {"subunit": subunits[-1], "value": 1}}
+    for big, small in zip(subunits, subunits[1:]):
+        divisions[big] = {"subunit": small, "value": rng.choice(DIVISIONS)}
+    return models.Denomination(name="denomination %d" % index,
+                               code="X%02d" % (index % 100),
+                               subunits=subunits,
+                               divisions=divisions,
+                               obsolete=obsolete)
+
+
+def make_piece(rng, denomination):
+    obsolete = denomination.obsolete or rng.random() < 0.05
+    return models.CurrencyPiece(
+        piece_type=rng.choice(("coin", "bill")),
+        obsolete=obsolete,
+        denomination=denomination.name,
+        value=rng.choice((1, 2, 5, 10, 20, 25, 50, 100)),
+        subunit=rng.choice(denomination.subunits),
+        year=rng.choice((0, rng.randint(1800, 2020))),
+        owner=rng.choice(OWNERS))
+
+
+def piece_counts(rng, num_countries, num_pieces):
+    """ Split the pieces unevenly between countries, like a real collection
+    """
+    weights = [rng.paretovariate(1.2) for _ in range(num_countries)]
+    scale = num_pieces / sum(weights)
+    counts = [int(weight * scale) for weight in weights]
+    counts[0] += num_pieces - sum(counts)
+    return counts
+
+
+def generate(directory, num_countries, num_pieces, depth=4, seed=0):
+    """ Write a synthetic data dir.  See the module docstring. """
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    country_dir = constants.COUNTRY_DIR
+    backend = constants.STORAGE_BACKEND
+    constants.COUNTRY_DIR = directory
+    constants.STORAGE_BACKEND = 'json'
+    try:
+        counts = piece_counts(rng, num_countries, num_pieces)
+        for index, count in enumerate(counts):
+            denominations = [
+                make_denomination(rng, i, depth, obsolete=i > 0)
+                for i in range(rng.randint(1, 4))]
+            inventory = [make_piece(rng, rng.choice(denominations))
+                         for _ in range(count)]
+            models.Country(short_name="synthetic-%05d" % index,
+                           long_name="Synthetic %d" % index,
+                           denominations=denominations,
+                           inventory=inventory).save()
+    finally:
+        constants.COUNTRY_DIR = country_dir
+        constants.STORAGE_BACKEND = backend
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    generate(args.directory, args.countries, args.pieces, args.depth,
+             args.seed)
+    print("Wrote %d countries with %d pieces to %s" %
+          (args.countries, args.pieces, args.directory))
+
+
+if __name__ == "__main__":
+    main()
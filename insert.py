@@ -1,20 +1,39 @@
 #!/usr/bin/env python3
+""" Add pieces of currency to the collection
+
+Pieces can be added one at a time from the command line, or in bulk from a
+CSV or JSON Lines file (or stdin) with ``--bulk``.  Bulk records have the same
+fields as the command line:  country, value, subunit, year, bill,
+denomination, obsolete and owner.  Only country, value and subunit are
+required.  CSV files must have a header row naming the fields.
+
+In bulk mode, every touched country is loaded, validated and saved exactly
+once.  Bad records are reported and skipped without aborting the batch.
+"""
 import argparse
+import csv
+import json
+import sys
 
 import models
 
+DEFAULT_OWNER = "Joel Friedly"
 
-def parse_args():
+
+def parse_args(argv=None):
     description = "Add a piece foreign currency to my collection."
     argparser = argparse.ArgumentParser(description=description)
     argparser.add_argument("country",
                            type=str,
+                           nargs='?',
                            help="Country the piece is from.")
     argparser.add_argument("value",
                            type=int,
+                           nargs='?',
                            help="Face value of the piece (integer)")
     argparser.add_argument("subunit",
                            type=str,
+                           nargs='?',
                            help=("Plural subunit of the piece (e.g. "
                                  "cents, dollars, etc.)"))
     argparser.add_argument("year",
@@ -42,10 +61,27 @@ def parse_args():
     argparser.add_argument("--owner",
                            type=str,
                            required=False,
-                           default="Joel Friedly",
+                           default=DEFAULT_OWNER,
                            help="Name of the owner of the piece.")
+    argparser.add_argument("--bulk",
+                           type=str,
+                           required=False,
+                           default='',
+                           help=("Read pieces from a CSV or JSON Lines file, "
+                                 "or - for stdin."))
+    argparser.add_argument("--format",
+                           choices=["csv", "jsonl"],
+                           required=False,
+                           default='',
+                           help=("Format of the --bulk input.  Guessed from "
+                                 "the input if not given."))
 
-    return argparser.parse_args()
+    args = argparser.parse_args(argv)
+    if not args.bulk and (args.country is None or args.value is None or
+                          args.subunit is None):
+        argparser.error("country, value and subunit are required unless "
+                        "--bulk is given")
+    return args
 
 
 def create_currency_unit(args):
@@ -65,10 +101,12 @@ def create_currency_unit(args):
     return models.CurrencyPiece.from_dict(currency_unit)
 
 
-def main():
-    args = parse_args()
-    country = models.Country.load(args.country)
+def apply_defaults(country, args):
+    """ Fill in the parts of a piece that default from its country
 
+    The denomination defaults to the country's most recent one, and a piece
+    from an obsolete denomination is always obsolete.
+    """
     if not args.denomination:
         args.denomination = country.denominations[0].name
     denomination = country.get_denomination(args.denomination)
@@ -76,8 +114,139 @@ def main():
     if not args.obsolete and denomination.obsolete:
         args.obsolete = True
 
-    country.inventory.append(create_currency_unit(args))
-    country.save()
+
+def parse_bool(value):
+    """ Parse a boolean field from a bulk record """
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ("1", "true", "t", "yes", "y")
+
+
+def parse_int(value, field):
+    """ Parse an integer field from a bulk record
+
+    JSON Lines records can hold numbers like 2.7, which ``int`` would quietly
+    truncate.  Those are rejected instead.
+    """
+    message = "%s must be a whole number, not %r" % (field, value)
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError(message)
+    if isinstance(value, float) and not value.is_integer():
+        raise ValueError(message)
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(message)
+
+
+def record_to_args(record):
+    """ Convert one bulk record into the same shape as the parsed CLI args """
+    for field in ("country", "value", "subunit"):
+        if record.get(field) in (None, ''):
+            raise ValueError("missing %s" % field)
+    return argparse.Namespace(country=record["country"],
+                              value=parse_int(record["value"], "value"),
+                              subunit=record["subunit"],
+                              year=parse_int(record.get("year") or 0,
+                                             "year"),
+                              bill=parse_bool(record.get("bill", False)),
+                              denomination=record.get("denomination") or '',
+                              obsolete=parse_bool(record.get("obsolete",
+                                                             False)),
+                              owner=record.get("owner") or DEFAULT_OWNER)
+
+
+def iter_records(bulk_file, input_format=''):
+    """ Yield (line number, record dict) for every record in a bulk file """
+    lines = iter(bulk_file)
+    first_line = ''
+    for first_line in lines:
+        if first_line.strip():
+            break
+    if not input_format:
+        is_json = first_line.lstrip().startswith('{')
+        input_format = "jsonl" if is_json else "csv"
+
+    def all_lines():
+        yield first_line
+        for line in lines:
+            yield line
+
+    if input_format == "csv":
+        reader = csv.DictReader(all_lines())
+        for record in reader:
+            yield reader.line_num, record
+    else:
+        for line_num, line in enumerate(all_lines(), 1):
+            if line.strip():
+                yield line_num, line
+
+
+def bulk_insert(bulk_file, input_format=''):
+    """ Insert every record from a bulk file
+
+    :returns:  The number of records that could not be inserted
+    """
+    errors = 0
+    by_country = {}
+    for line_num, record in iter_records(bulk_file, input_format):
+        try:
+            if isinstance(record, str):
+                record = json.loads(record)
+            args = record_to_args(record)
+        except (ValueError, TypeError, AttributeError) as e:
+            print("line %d:  %s" % (line_num, e), file=sys.stderr)
+            errors += 1
+            continue
+        by_country.setdefault(args.country, []).append((line_num, args))
+
+    for short_name, rows in by_country.items():
+        if not models.Country.exists(short_name):
+            for line_num, _ in rows:
+                print("line %d:  no such country %s" % (line_num, short_name),
+                      file=sys.stderr)
+            errors += len(rows)
+            continue
+        added = 0
+        # Hold the country's lock from loading to saving, so that nobody
+        # else's pieces are lost.  Nothing is written if nothing was added.
+        with models.Country.edit(short_name) as country:
+            for line_num, args in rows:
+                try:
+                    apply_defaults(country, args)
+                    piece = create_currency_unit(args)
+                    country.validate_piece(piece)
+                except (AssertionError, KeyError) as e:
+                    print("line %d:  %s" % (line_num, e), file=sys.stderr)
+                    errors += 1
+                    continue
+                country.inventory.append(piece)
+                added += 1
+        print("Added %d pieces to %s" % (added, short_name))
+    return errors
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.bulk:
+        if args.bulk == '-':
+            errors = bulk_insert(sys.stdin, args.format)
+        else:
+            with open(args.bulk, 'r', newline='') as bulk_file:
+                errors = bulk_insert(bulk_file, args.format)
+        if errors:
+            sys.exit(1)
+        return
+
+    # The denominations are all that's needed to check the piece, so don't
+    # read the inventory
+    country = models.Country.load_header(args.country)
+    apply_defaults(country, args)
+    piece = create_currency_unit(args)
+    country.validate_piece(piece)
+    # Appending to the journal avoids rewriting the whole data file for every
+    # piece.  Run compact.py to fold the journal into the data file.
+    models.Country.append_to_journal(country.short_name, [piece])
 
 
 if __name__ == "__main__":
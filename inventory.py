@@ -0,0 +1,228 @@
+""" Column-oriented storage for a country's inventory
+
+`models.Country.inventory` is normally a list of `models.CurrencyPiece`
+objects.  That's easy to work with, but it's slow to total up large
+collections because every piece is a separate Python object with string
+attributes.
+
+`ColumnarInventory` stores the same data as one typed ``array`` per
+attribute.  Strings that repeat a lot (denominations, subunits, owners and the
+piece type) are stored as small integer codes into per-inventory lookup
+tables.  It behaves enough like a list of pieces (``len``, iteration,
+``append``) that it can be dropped in as a country's inventory.  Ask the
+loader for one::
+
+    country = models.Country.load('canada', columnar=True)
+
+Everything else keeps working, including ``to_dict`` and ``save``, and
+``total.total`` and ``total.total_all`` notice the columnar inventory and use
+its grouped sums.  The sums are worked out once, before the country goes into
+the on-disk cache, so a warm load doesn't look at the pieces at all.
+
+Pieces that only differ in their year, owner or type add the same amount to
+the same group, so each piece also gets the code of its "kind" (denomination,
+obsolete, subunit and value).  There are usually only a few dozen kinds, and
+counting small integer codes with ``collections.Counter`` is several times
+faster than looking at every piece.  If numpy is installed, the grouped sums
+are computed with ``numpy.bincount`` over the arrays without copying them.
+"""
+from array import array
+import collections
+
+import models
+
+_NUMPY = []
+
+
+def _numpy():
+    """ Import numpy the first time it's needed, or return None without it
+
+    numpy takes longer to import than most of the scripts take to run, so it
+    isn't imported until there's an inventory to add up.
+    """
+    if not _NUMPY:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _NUMPY.append(numpy)
+    return _NUMPY[0]
+
+
+class _CodeTable(object):
+    """ Bidirectional mapping between values and small integer codes """
+
+    def __init__(self, names=()):
+        self.names = []
+        self.codes = {}
+        for name in names:
+            self.code(name)
+
+    def code(self, name):
+        try:
+            return self.codes[name]
+        except KeyError:
+            self.codes[name] = len(self.names)
+            self.names.append(name)
+            return self.codes[name]
+
+    def __len__(self):
+        return len(self.names)
+
+
+class ColumnarInventory(object):
+    """ An inventory of currency pieces stored as typed columns
+
+    The columns are public so that tools can read them directly, but they
+    should only be modified through `append` and `extend` so that the lookup
+    tables and cached sums stay consistent.
+    """
+
+    def __init__(self):
+        self.piece_types = _CodeTable(['coin', 'bill'])
+        self.denominations = _CodeTable()
+        self.subunits = _CodeTable()
+        self.owners = _CodeTable()
+        self.piece_type = array('B')
+        self.obsolete = array('B')
+        self.denomination = array('I')
+        self.subunit = array('I')
+        # Values are stored as doubles, which are exact for any integer below
+        # 2**53.  We remember which values were integers so that to_dict()
+        # gives back exactly what was put in.
+        self.value = array('d')
+        self.value_is_int = array('B')
+        self.year = array('l')
+        self.owner = array('I')
+        # (denomination code, obsolete, subunit code, value) of each piece
+        self.kinds = _CodeTable()
+        self.kind = array('I')
+        # Maps (denomination code, subunit code, obsolete) to the sum of the
+        # values in that group.  Built lazily, and kept up to date by append.
+        self._sums = None
+
+    @classmethod
+    def from_pieces(cls, pieces):
+        columns = cls()
+        columns.extend(pieces)
+        return columns
+
+    @classmethod
+    def from_dicts(cls, piece_dicts):
+        """ Build an inventory from the dicts stored in a country's data file
+        """
+        return cls.from_pieces(
+            models.CurrencyPiece.from_dict(piece_dict)
+            for piece_dict in piece_dicts)
+
+    def append(self, piece):
+        denomination = self.denominations.code(piece.denomination)
+        subunit = self.subunits.code(piece.subunit)
+        obsolete = 1 if piece.obsolete else 0
+        self.piece_type.append(self.piece_types.code(piece.piece_type))
+        self.obsolete.append(obsolete)
+        self.denomination.append(denomination)
+        self.subunit.append(subunit)
+        self.value.append(piece.value)
+        self.value_is_int.append(1 if isinstance(piece.value, int) else 0)
+        self.year.append(piece.year)
+        self.owner.append(self.owners.code(piece.owner))
+        self.kind.append(self.kinds.code(
+            (denomination, obsolete, subunit, piece.value)))
+        if self._sums is not None:
+            key = (denomination, subunit, obsolete)
+            self._sums[key] = self._sums.get(key, 0) + piece.value
+
+    def extend(self, pieces):
+        for piece in pieces:
+            self.append(piece)
+
+    def __len__(self):
+        return len(self.value)
+
+    def piece(self, index):
+        """ Build the `models.CurrencyPiece` stored at an index """
+        value = self.value[index]
+        if self.value_is_int[index]:
+            value = int(value)
+        return models.CurrencyPiece(
+            piece_type=self.piece_types.names[self.piece_type[index]],
+            obsolete=bool(self.obsolete[index]),
+            denomination=self.denominations.names[self.denomination[index]],
+            value=value,
+            subunit=self.subunits.names[self.subunit[index]],
+            year=self.year[index],
+            owner=self.owners.names[self.owner[index]])
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.piece(index)
+
+    def to_pieces(self):
+        return list(self)
+
+    def to_dicts(self):
+        return [piece.to_dict() for piece in self]
+
+    def _compute_sums(self):
+        numpy = _numpy() if len(self) else None
+        if numpy is None:
+            self._sums = self._kind_sums()
+        else:
+            self._sums = self._numpy_sums(numpy)
+
+    def _kind_sums(self):
+        """ Group sums from counting how many pieces there are of each kind
+        """
+        sums = {}
+        kinds = self.kinds.names
+        for kind, count in collections.Counter(self.kind).items():
+            denom, obsolete, subunit, value = kinds[kind]
+            key = (denom, subunit, obsolete)
+            sums[key] = sums.get(key, 0) + value * count
+        return {key: float(value_sum) for key, value_sum in sums.items()}
+
+    def _numpy_sums(self, numpy):
+        """ Group sums from ``numpy.bincount`` over the columns """
+        num_subunits = len(self.subunits)
+        num_groups = len(self.denominations) * num_subunits * 2
+        denom = numpy.frombuffer(self.denomination, dtype=numpy.uint32)
+        subunit = numpy.frombuffer(self.subunit, dtype=numpy.uint32)
+        obsolete = numpy.frombuffer(self.obsolete, dtype=numpy.uint8)
+        keys = ((denom.astype(numpy.int64) * num_subunits + subunit) * 2 +
+                obsolete)
+        values = numpy.frombuffer(self.value, dtype=numpy.float64)
+        grouped = numpy.bincount(keys, weights=values, minlength=num_groups)
+        present = numpy.bincount(keys, minlength=num_groups)
+        sums = {}
+        for key in numpy.flatnonzero(present).tolist():
+            value_sum = float(grouped[key])
+            key, obsolete = divmod(key, 2)
+            denom, subunit = divmod(key, num_subunits)
+            sums[(denom, subunit, obsolete)] = value_sum
+        return sums
+
+    def sums(self):
+        """ Sum the face values of every piece, grouped in a single pass
+
+        :returns:  A dict mapping (denomination name, obsolete, subunit) to
+                   the sum of the values of the pieces in that group
+        """
+        if self._sums is None:
+            self._compute_sums()
+        denominations = self.denominations.names
+        subunits = self.subunits.names
+        sums = {}
+        for (denom, subunit, obsolete), value_sum in self._sums.items():
+            key = (denominations[denom], bool(obsolete), subunits[subunit])
+            sums[key] = value_sum
+        return sums
+
+    def iter_group(self, denomination, obsolete):
+        """ Yield the pieces of one denomination with one obsolete flag """
+        denom = self.denominations.codes.get(denomination)
+        obsolete = 1 if obsolete else 0
+        for index in range(len(self)):
+            if (self.denomination[index] == denom and
+                    self.obsolete[index] == obsolete):
+                yield self.piece(index)
@@ -0,0 +1,133 @@
+""" Read a big JSON document a value at a time
+
+``json.load`` reads a whole file and builds every object in it before
+returning.  A country's data file is one object whose ``inventory`` list can
+hold millions of pieces, and most of the things we do with it (totals, counts,
+exports) only need to look at each piece once.
+
+`JSONStream` keeps one chunk of the file in memory and decodes one value at a
+time with ``json.JSONDecoder.raw_decode``.  `iter_object` walks the members of
+a top-level object, handing out big lists as iterators instead of lists::
+
+    with open(path) as json_file:
+        for key, value in jsonstream.iter_object(JSONStream(json_file),
+                                                 stream_keys={'inventory'}):
+            if key == 'inventory':
+                for piece_dict in value:
+                    ...
+
+Memory use depends on the size of the biggest single value that isn't
+streamed, not on the size of the file.
+"""
+import json
+import re
+
+CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class JSONStream(object):
+    """ A text file, read one JSON value or punctuation mark at a time """
+
+    def __init__(self, json_file, chunk_size=CHUNK_SIZE):
+        self.json_file = json_file
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        """ Read another chunk, dropping everything before `pos`
+
+        :returns:  False at the end of the file
+        """
+        chunk = self.json_file.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """ Skip whitespace and return the next character, or '' at the end
+        """
+        while True:
+            self.pos = _WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ''
+
+    def next_char(self):
+        char = self.peek()
+        self.pos += 1
+        return char
+
+    def expect(self, expected):
+        char = self.next_char()
+        if char != expected:
+            raise ValueError("Expected %r but found %r" % (expected, char))
+
+    def value(self):
+        """ Decode the next complete JSON value """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                # Probably cut off at the end of the chunk
+                if not self._fill():
+                    raise
+                continue
+            # A number at the end of the chunk might continue in the next one
+            if end == len(self.buffer) and not self.eof and self._fill():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_array(stream):
+    """ Yield the items of the JSON array that's next in `stream` """
+    stream.expect('[')
+    if stream.peek() == ']':
+        stream.next_char()
+        return
+    while True:
+        yield stream.value()
+        char = stream.next_char()
+        if char == ']':
+            return
+        if char != ',':
+            raise ValueError("Expected ',' or ']' but found %r" % char)
+
+
+def iter_object(stream, stream_keys=()):
+    """ Yield (key, value) for each member of the JSON object next in `stream`
+
+    :param stream_keys:  Keys whose values are arrays to hand out as
+                         iterators (see `iter_array`).  Each one must be used
+                         up before asking for the next member, or it's
+                         skipped.
+    """
+    stream.expect('{')
+    if stream.peek() == '}':
+        stream.next_char()
+        return
+    while True:
+        key = stream.value()
+        stream.expect(':')
+        if key in stream_keys:
+            items = iter_array(stream)
+            yield key, items
+            for _ in items:
+                pass
+        else:
+            yield key, stream.value()
+        char = stream.next_char()
+        if char == '}':
+            return
+        if char != ',':
+            raise ValueError("Expected ',' or '}' but found %r" % char)
@@ -0,0 +1,93 @@
+""" Per-country locks, so that several processes can write at once
+
+Every country has a hidden lock file next to its data file.  Holding the lock
+(with ``fcntl.flock``) gives one process at a time the right to change the
+country's data file or journal::
+
+    with locks.country_lock('canada'):
+        ...
+
+The locks are advisory, so they only keep out other code that takes them
+(``models.Country.save``, ``append_to_journal`` and ``edit`` all do).  They're
+reentrant within a thread, and threads of one process exclude each other too.
+On platforms without ``fcntl`` they only exclude threads of the same process.
+
+A lock file only exists while its lock is held.  The holder deletes it before
+releasing the lock, so a process that was waiting on the deleted file finds
+that it holds a lock nobody else can see, and tries again with a new file.
+"""
+import contextlib
+import os
+import threading
+
+import constants
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class _CountryLock(object):
+    """ The state of one country's lock within this process """
+
+    def __init__(self):
+        self.thread_lock = threading.RLock()
+        self.depth = 0
+        self.lock_file = None
+
+
+# Lock file path -> _CountryLock
+_LOCKS = {}
+_LOCKS_LOCK = threading.Lock()
+
+
+def lock_path(short_name):
+    return os.path.join(constants.COUNTRY_DIR, ".%s.lock" % short_name)
+
+
+@contextlib.contextmanager
+def country_lock(short_name):
+    """ Hold a country's lock for the duration of a ``with`` block
+
+    Blocks until every other holder has released it.
+    """
+    path = lock_path(short_name)
+    with _LOCKS_LOCK:
+        lock = _LOCKS.setdefault(path, _CountryLock())
+    with lock.thread_lock:
+        if lock.depth == 0:
+            lock.lock_file = _acquire(path)
+        lock.depth += 1
+        try:
+            yield
+        finally:
+            lock.depth -= 1
+            if lock.depth == 0:
+                # Delete the file while it's still locked, then close it to
+                # release the flock
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                lock.lock_file.close()
+                lock.lock_file = None
+
+
+def _acquire(path):
+    """ Open and lock the lock file at `path`, waiting for other processes
+
+    :returns:  The open lock file.  Closing it releases the lock.
+    """
+    while True:
+        lock_file = open(path, 'a')
+        if fcntl is None:
+            return lock_file
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        # The last holder may have deleted the file while we waited on it
+        try:
+            if os.stat(path).st_ino == os.fstat(lock_file.fileno()).st_ino:
+                return lock_file
+        except FileNotFoundError:
+            pass
+        lock_file.close()
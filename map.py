@@ -5,21 +5,38 @@ This script uses data from Natural Earth for country borders and plots them
 onto a map using Cartopy with matplotlib.
 
 http://www.naturalearthdata.com/
+
+Cartopy and matplotlib take a long time to import, so they're imported inside
+the functions that draw, not at the top of this module.  That keeps
+``load_countries`` and friends cheap to import from other tools.
 """
 import argparse
+import bisect
 import logging
 import enum
-from cartopy import crs
-from cartopy.io import shapereader
-from matplotlib import pyplot
+import multiprocessing
+import os
+import pickle
+import time
 
 import constants
 import models
+import profiling
+import storage
 import total
 
 COLOR_NOT_PRESENT = (1.0, 1.0, 1.0)
 COLOR_OBSOLETE = (0.4, 0.4, 0.8)
 COLOR_PRESENT = (0.2, 0.2, 0.9)
+# Choropleth maps shade present countries between these two colors
+COLOR_SCALE_LOW = (0.8, 0.8, 1.0)
+COLOR_SCALE_HIGH = (0.0, 0.0, 0.5)
+
+# Use a larger figure size for more pixels.  4:3 is a nice ratio though
+FIGURE_SIZE = (16, 12)
+
+# Bump this whenever the format of the geometry cache changes
+GEOMETRY_CACHE_VERSION = 1
 
 
 class Resolutions(enum.Enum):
@@ -44,7 +61,7 @@ def _get_long_name(country):
         return country.attributes['NAME_LONG']
 
 
-def parse_args():
+def parse_args(argv=None):
     description = "Generate a map of countries that I have currency pieces for"
     argparser = argparse.ArgumentParser(description=description)
     argparser.add_argument("--med-res",
@@ -60,7 +77,109 @@ def parse_args():
                            default=False,
                            action="store_true",
                            help="use high resolution map data")
-    return argparser.parse_args()
+    argparser.add_argument("--simplify",
+                           "-s",
+                           required=False,
+                           default=False,
+                           action="store_true",
+                           help=("simplify borders to the output resolution "
+                                 "before drawing them"))
+    argparser.add_argument("--choropleth",
+                           "-c",
+                           choices=["count", "value"],
+                           required=False,
+                           default='',
+                           help=("shade countries by piece count or by "
+                                 "face-value total, and write the map to "
+                                 "map-METRIC.png"))
+    argparser.add_argument("--bins",
+                           choices=["quantile", "log"],
+                           required=False,
+                           default="quantile",
+                           help="how to bin --choropleth values")
+    argparser.add_argument("--num-bins",
+                           type=int,
+                           required=False,
+                           default=5,
+                           help="number of --choropleth bins")
+    argparser.add_argument("--targets",
+                           "-t",
+                           nargs='+',
+                           type=parse_target,
+                           required=False,
+                           default=[],
+                           metavar="RES:FORMAT[:WxH]",
+                           help=("render several maps at once, e.g. "
+                                 "110m:png 10m:svg:32x24.  Each is written "
+                                 "to map-RES-WxH.FORMAT, or with "
+                                 "--choropleth, to "
+                                 "map-choropleth-METRIC-RES-WxH.FORMAT"))
+    argparser.add_argument("--jobs",
+                           "-j",
+                           type=int,
+                           required=False,
+                           default=multiprocessing.cpu_count(),
+                           help="number of --targets to render at once")
+    argparser.add_argument("--profile",
+                           required=False,
+                           default=False,
+                           action="store_true",
+                           help="Print where the time went when done.")
+    argparser.add_argument("--watch",
+                           "-w",
+                           required=False,
+                           default=False,
+                           action="store_true",
+                           help=("keep running, and draw the map again "
+                                 "whenever a country's color changes"))
+    return argparser.parse_args(argv)
+
+
+class Target(object):
+    """ One map to render:  a resolution, an output format and a size, and
+    for a choropleth, the metric it's shaded by
+    """
+
+    def __init__(self, resolution, output_format, size=FIGURE_SIZE,
+                 metric=None):
+        self.resolution = resolution
+        self.output_format = output_format
+        self.size = size
+        self.metric = metric
+
+    @property
+    def filename(self):
+        # Choropleths get their own names, so they don't overwrite the plain
+        # maps
+        mode = "map"
+        if self.metric:
+            mode = "map-choropleth-%s" % self.metric
+        return "%s-%s-%gx%g.%s" % (mode, self.resolution.value, self.size[0],
+                                   self.size[1], self.output_format)
+
+    def __str__(self):
+        return self.filename
+
+
+def parse_target(spec):
+    """ Parse a --targets argument like "10m:svg:32x24" into a Target """
+    parts = spec.split(':')
+    if len(parts) not in (2, 3):
+        raise argparse.ArgumentTypeError("expected RES:FORMAT[:WxH]")
+    try:
+        resolution = Resolutions(parts[0])
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "resolution must be one of %s" %
+            ", ".join(r.value for r in Resolutions))
+    size = FIGURE_SIZE
+    if len(parts) == 3:
+        try:
+            width, height = parts[2].lower().split('x')
+            size = (float(width), float(height))
+        except ValueError:
+            raise argparse.ArgumentTypeError("size must look like 16x12")
+    return Target(resolution, parts[1].lower(), size)
 
 
 def get_resolution(args):
@@ -73,19 +192,48 @@ def get_resolution(args):
     return Resolutions.low_res
 
 
-def load_countries():
+@profiling.timed("load_collection")
+def load_collection():
+    """ Load every country and compute all of their totals in one pass
+
+    :returns:  A (countries, totals) tuple, where totals is the result of
+               `total.total_all`
+    """
+    countries = models.Country.load_all(columnar=True)
+    return countries, total.total_all(countries)
+
+
+def load_countries(collection=None):
     """ Loads countries from the data dir and returns them
 
+    :param collection:  The result of `load_collection`, if it's already been
+                        loaded
     :returns:  a dictionary of country names mapped to non-obsolete totals
     """
-    countries = models.Country.load_all()
-    country_totals = {c.long_name: total.total(c) for c in countries}
+    countries, totals = collection or load_collection()
+    country_totals = {c.long_name: total.lookup_total(totals, c)
+                      for c in countries}
 
     # This map would look pretty silly if the US wasn't blue.
     country_totals["United States"] = 1.00
     return country_totals
 
 
+def load_metric(metric, collection):
+    """ Compute a number per country to shade a choropleth map with
+
+    :param metric:  "count" for the number of pieces, or "value" for the
+                    non-obsolete total in the current denomination's principal
+                    unit
+    :param collection:  The result of `load_collection`
+    :returns:  a dictionary of country names mapped to the metric
+    """
+    countries, totals = collection
+    if metric == "count":
+        return {c.long_name: len(c.inventory) for c in countries}
+    return {c.long_name: total.lookup_total(totals, c) for c in countries}
+
+
 def correct_for_mapping(countries):
     """ Convert currency-oriented data to map-oriented data
 
@@ -151,6 +299,8 @@ def iter_country_shapes(resolution):
 
     :param resolution: an instance of Resolutions to iterate countries at.
     """
+    from cartopy.io import shapereader
+
     geodata = shapereader.natural_earth(resolution=resolution.value,
                                         category='cultural',
                                         name='admin_0_countries')
@@ -158,6 +308,87 @@ def iter_country_shapes(resolution):
     return georeader.records()
 
 
+def _shapefile_key(shapefile):
+    """ Identify the current version of a shapefile and its sidecar files """
+    base, _ = os.path.splitext(shapefile)
+    key = []
+    for extension in ('.shp', '.shx', '.dbf'):
+        try:
+            stat = os.stat(base + extension)
+        except FileNotFoundError:
+            key.append(None)
+            continue
+        key.append((stat.st_mtime_ns, stat.st_size))
+    return (shapefile, tuple(key))
+
+
+def _geometry_cache_path(resolution):
+    return os.path.join(constants.CACHE_DIR,
+                        "geometry-%s.pickle" % resolution.value)
+
+
+# Geometries loaded by this process, by Resolutions value.  render_targets
+# hands its workers a copy, so they never touch the disk.
+_SHAPES = {}
+
+
+@profiling.timed("load_country_shapes")
+def load_country_shapes(resolution):
+    """ Get the geometries of all Natural Earth countries, indexed by name
+
+    Reading the shapefile is the slowest part of drawing the map, especially
+    at high resolution, so the parsed geometries are cached in
+    ``constants.CACHE_DIR``.  The cache is rebuilt whenever the shapefile
+    changes.  Geometries are stored already projected to the map's
+    projection, so that cartopy doesn't need to project them while drawing.
+
+    :param resolution: an instance of Resolutions to load countries at.
+    :returns:  A dict mapping Natural Earth long names to lists of geometries,
+               in shapefile order
+    """
+    from cartopy import crs
+    from cartopy.io import shapereader
+
+    if resolution.value in _SHAPES:
+        return _SHAPES[resolution.value]
+    geodata = shapereader.natural_earth(resolution=resolution.value,
+                                        category='cultural',
+                                        name='admin_0_countries')
+    source_key = _shapefile_key(geodata)
+    cache_path = _geometry_cache_path(resolution)
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            entry = pickle.load(cache_file)
+        if (entry['version'] == GEOMETRY_CACHE_VERSION and
+                entry['source'] == source_key):
+            _SHAPES[resolution.value] = entry['shapes']
+            return entry['shapes']
+    except Exception:  # pylint: disable=W0703
+        # A missing or unreadable cache just means we have to rebuild it
+        pass
+
+    LOGGER.info("Building %s geometry cache", resolution.value)
+    projection = crs.PlateCarree()
+    shapes = {}
+    for country in shapereader.Reader(geodata).records():
+        geometry = projection.project_geometry(country.geometry, projection)
+        shapes.setdefault(_get_long_name(country), []).append(geometry)
+    try:
+        os.makedirs(constants.CACHE_DIR, exist_ok=True)
+        tmp_path = "%s.%d.tmp" % (cache_path, os.getpid())
+        with open(tmp_path, 'wb') as cache_file:
+            pickle.dump(dict(version=GEOMETRY_CACHE_VERSION,
+                             source=source_key,
+                             shapes=shapes),
+                        cache_file,
+                        pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        LOGGER.warning("Could not write geometry cache %s", cache_path)
+    _SHAPES[resolution.value] = shapes
+    return shapes
+
+
 def natural_earth_country_list(resolution):
     """ Name every country according to Natural Earth
 
@@ -165,50 +396,300 @@ def natural_earth_country_list(resolution):
 
     :param resolution: an instance of Resolutions to iterate countries at.
     """
-    country_names = []
-    for country in iter_country_shapes(resolution):
-        country_names.append(_get_long_name(country))
-    return country_names
+    return list(load_country_shapes(resolution))
+
+
+def country_color(long_name, countries_owned):
+    """ Pick the fill color for a Natural Earth country """
+    if long_name not in countries_owned:
+        return COLOR_NOT_PRESENT
+    if countries_owned[long_name]:
+        LOGGER.info("Adding %s", long_name)
+        return COLOR_PRESENT
+    LOGGER.info("Adding %s as obsolete", long_name)
+    return COLOR_OBSOLETE
+
+
+def bin_edges(values, binning, num_bins):
+    """ Split sorted positive values into bins
+
+    :param binning:  "quantile" for bins holding equal numbers of countries,
+                     or "log" for bins of equal width on a log scale
+    :returns:  the sorted inner edges between bins.  A value belongs in bin
+               ``bisect.bisect_right(edges, value)``.
+    """
+    if not values or num_bins < 2:
+        return []
+    if binning == "log":
+        low, high = values[0], values[-1]
+        ratio = (high / low) ** (1.0 / num_bins)
+        edges = [low * ratio ** i for i in range(1, num_bins)]
+    else:
+        edges = [values[len(values) * i // num_bins]
+                 for i in range(1, num_bins)]
+    return sorted(set(edges))
+
+
+def _blend(low, high, fraction):
+    return tuple(l + (h - l) * fraction for l, h in zip(low, high))
+
+
+class Choropleth(object):
+    """ Colors present countries by binning a number, like the piece count """
+
+    def __init__(self, title, values, countries_owned, binning="quantile",
+                 num_bins=5):
+        """
+        :param title:  The legend title
+        :param values:  A dictionary of country names mapped to numbers
+        :param countries_owned:  The same dictionary `create_world_map` takes
+        """
+        self.title = title
+        self.values = values
+        self.countries_owned = countries_owned
+        positive = sorted(v for v in values.values() if v > 0)
+        self.edges = bin_edges(positive, binning, num_bins)
+        num_colors = len(self.edges) + 1
+        self.colors = [_blend(COLOR_SCALE_LOW, COLOR_SCALE_HIGH,
+                              i / max(1, num_colors - 1))
+                       for i in range(num_colors)]
+        self.low = positive[0] if positive else 0
+        self.high = positive[-1] if positive else 0
+
+    def color(self, long_name):
+        if long_name not in self.countries_owned:
+            return COLOR_NOT_PRESENT
+        if not self.countries_owned[long_name]:
+            return COLOR_OBSOLETE
+        value = self.values.get(long_name, 0)
+        return self.colors[bisect.bisect_right(self.edges, value)]
+
+    def legend_handles(self):
+        from matplotlib import patches
+
+        bounds = [self.low] + self.edges + [self.high]
+        handles = []
+        for i, color in enumerate(self.colors):
+            label = "%g \u2013 %g" % (bounds[i], bounds[i + 1])
+            handles.append(patches.Patch(facecolor=color, edgecolor='gray',
+                                         label=label))
+        handles.append(patches.Patch(facecolor=COLOR_OBSOLETE,
+                                     edgecolor='gray',
+                                     label="obsolete only"))
+        return handles
+
+
+def simplify_tolerance(figure):
+    """ The largest border simplification that can't be seen in the output
+
+    That's half of one output pixel, in degrees of longitude.
+    """
+    width_inches, _ = figure.get_size_inches()
+    return 360.0 / (width_inches * figure.dpi) / 2
 
 
-def create_world_map(args, countries_owned):
+def create_world_map(resolution,
+                     countries_owned,
+                     output="map.png",
+                     size=FIGURE_SIZE,
+                     simplify=False,
+                     choropleth=None):
     """ Creates a plot object of a world map with present countries highlighted
 
+    Countries are grouped by fill color and each group is drawn as a single
+    collection.  Drawing each country separately creates hundreds (or, at high
+    resolution, thousands) of matplotlib artists, and the per-artist overhead
+    dominates the rendering time.
+
+    :param resolution:  an instance of Resolutions to draw the map at.
     :param countries_owned:  A dictionary of country names mapped to boolean
                              values.  Falsey boolean values indicate that the
                              country is present, but all present currency is
                              obsolete.
+    :param output:  The file to save the map to.  Its extension picks the
+                    format.
+    :param size:  The figure size, in inches.
+    :param simplify:  Simplify borders to the output resolution.
+    :param choropleth:  A `Choropleth` to shade present countries with, and
+                        to draw a legend for.
     """
+    from cartopy import crs
+    from matplotlib import pyplot
+
     # based on http://stackoverflow.com/questions/13397022
-    plot = pyplot.axes(projection=crs.PlateCarree())
-    for country in iter_country_shapes(get_resolution(args)):
-        color = COLOR_NOT_PRESENT
-        long_name = _get_long_name(country)
+    figure = pyplot.figure(figsize=size)
+    plot = figure.add_subplot(1, 1, 1, projection=crs.PlateCarree())
+    shapes = load_country_shapes(resolution)
+    # Draw present countries last so that their borders end up on top
+    if choropleth is None:
+        colors = [COLOR_NOT_PRESENT, COLOR_OBSOLETE, COLOR_PRESENT]
+    else:
+        colors = [COLOR_NOT_PRESENT, COLOR_OBSOLETE] + choropleth.colors
+    groups = {color: [] for color in colors}
+    for long_name, geometries in shapes.items():
         LOGGER.debug("Examining country from Natural Earth:  %s", long_name)
-        if long_name in countries_owned:
-            if countries_owned[long_name]:
-                LOGGER.info("Adding %s", long_name)
-                color = COLOR_PRESENT
-            else:
-                LOGGER.info("Adding %s as obsolete", long_name)
-                color = COLOR_OBSOLETE
-        plot.add_geometries(country.geometry,
-                            crs.PlateCarree(),
-                            facecolor=color,
-                            edgecolor='gray')
+        if choropleth is None:
+            color = country_color(long_name, countries_owned)
+        else:
+            color = choropleth.color(long_name)
+        groups[color].extend(geometries)
+
+    tolerance = simplify_tolerance(figure) if simplify else 0
+    for color, geometries in groups.items():
+        if not geometries:
+            continue
+        if tolerance:
+            geometries = [geometry.simplify(tolerance, preserve_topology=True)
+                          for geometry in geometries]
+        with profiling.span("add_geometries"):
+            plot.add_geometries(geometries,
+                                plot.projection,
+                                facecolor=color,
+                                edgecolor='gray')
     plot.coastlines()
-    # Use a larger figure size for more pixels.  4:3 is a nice ratio though
-    plot.figure.set_size_inches(16, 12)
-    pyplot.savefig("map.png", bbox_inches='tight')
-
-
-def main():
+    if choropleth is not None:
+        plot.legend(handles=choropleth.legend_handles(),
+                    title=choropleth.title,
+                    loc='lower left')
+    with profiling.span("savefig"):
+        figure.savefig(output, bbox_inches='tight')
+    pyplot.close(figure)
+
+
+def _init_worker(shapes):
+    """ Start a render_targets worker with the geometries already loaded """
+    _SHAPES.update(shapes)
+
+
+def _render_target(job):
+    """ Render one Target in a worker process and time it """
+    from matplotlib import pyplot
+
+    target, countries_owned, simplify, choropleth = job
+    # Worker processes have no use for an interactive backend
+    pyplot.switch_backend('Agg')
+    start = time.time()
+    create_world_map(target.resolution,
+                     countries_owned,
+                     output=target.filename,
+                     size=target.size,
+                     simplify=simplify,
+                     choropleth=choropleth)
+    return target, time.time() - start
+
+
+def render_targets(targets, countries_owned, jobs, simplify=False,
+                   choropleth=None):
+    """ Render several maps at once in a process pool
+
+    The country data is loaded once by the caller, and the geometries for
+    every resolution are loaded once here and handed to the workers as they
+    start, so the workers only draw.  Forked workers get them for free.
+    Where there's no fork (Windows, and macOS by default), they're pickled
+    over to each worker once.
+    """
+    shapes = {resolution.value: load_country_shapes(resolution)
+              for resolution in set(target.resolution for target in targets)}
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context()
+    start = time.time()
+    work = [(target, countries_owned, simplify, choropleth)
+            for target in targets]
+    with context.Pool(max(1, min(jobs, len(targets))),
+                      initializer=_init_worker,
+                      initargs=(shapes,)) as pool:
+        for target, seconds in pool.imap_unordered(_render_target, work):
+            print("%-36s %6.2fs" % (target, seconds))
+    print("%-36s %6.2fs" % ("all targets", time.time() - start))
+
+
+def map_state(args, collection):
+    """ Work out everything that decides what the map looks like
+
+    :returns:  A (mappable countries, choropleth or None, state) tuple.  The
+               map only needs drawing again when the state changes:  that's
+               whether each country is present or obsolete, and for a
+               choropleth the values it's shaded by.
+    """
+    countries_owned = load_countries(collection)
+    mappable_countries = correct_for_mapping(countries_owned)
+    state = {name: bool(value) for name, value in mappable_countries.items()}
+    choropleth = None
+    if args.choropleth:
+        values = correct_for_mapping(load_metric(args.choropleth, collection))
+        title = {"count": "Pieces", "value": "Face value"}[args.choropleth]
+        choropleth = Choropleth(title, values, mappable_countries,
+                                binning=args.bins, num_bins=args.num_bins)
+        state = (state, values)
+    return mappable_countries, choropleth, state
+
+
+def draw(args, mappable_countries, choropleth):
+    """ Draw the map (or every --targets map) """
+    output = "map.png"
+    if args.choropleth:
+        output = "map-%s.png" % args.choropleth
+    if args.targets:
+        targets = [Target(target.resolution, target.output_format,
+                          target.size, args.choropleth)
+                   for target in args.targets]
+        render_targets(targets, mappable_countries, args.jobs,
+                       simplify=args.simplify, choropleth=choropleth)
+    else:
+        create_world_map(get_resolution(args),
+                         mappable_countries,
+                         output=output,
+                         simplify=args.simplify,
+                         choropleth=choropleth)
+
+
+def watch_map(args):
+    """ Draw the map, and draw it again whenever the data changes in a way
+    that shows on it
+    """
+    # Only the watch loop needs these
+    import catalog as currency_catalog
+    import watch
+
+    catalog = currency_catalog.Catalog()
+    watcher = watch.create_watcher()
+    mappable_countries, choropleth, state = map_state(args,
+                                                      catalog.collection())
+    draw(args, mappable_countries, choropleth)
+    LOGGER.info("Watching %s for changes", storage.location())
+    try:
+        while True:
+            changed = watch.wait_for_changes(watcher)
+            catalog.reload(changed)
+            mappable_countries, choropleth, new_state = map_state(
+                args, catalog.collection())
+            if new_state == state:
+                LOGGER.info("%s changed, but the map didn't",
+                            ', '.join(sorted(changed)))
+                continue
+            LOGGER.info("%s changed, drawing the map again",
+                        ', '.join(sorted(changed)))
+            draw(args, mappable_countries, choropleth)
+            state = new_state
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+
+def main(argv=None):
     logging.basicConfig(level='INFO')
     LOGGER.info("Generating map")
-    args = parse_args()
-    countries_owned = load_countries()
-    mappable_countries = correct_for_mapping(countries_owned)
-    create_world_map(args, mappable_countries)
+    args = parse_args(argv)
+    if args.profile:
+        profiling.enable()
+    if args.watch:
+        watch_map(args)
+        return
+    mappable_countries, choropleth, _ = map_state(args, load_collection())
+    draw(args, mappable_countries, choropleth)
 
 
 if __name__ == "__main__":
@@ -1,8 +1,19 @@
-import json
+import itertools
 import os
 import sys
+import time
+import types
+import weakref
 
 import constants
+import profiling
+
+
+class StaleCountryError(Exception):
+    """ Raised by `Country.save` when someone else changed the stored country
+    after it was loaded.  Load it again and redo the change, or use
+    `Country.edit` so that nobody can.
+    """
 
 
 class Country(object):
@@ -22,14 +33,68 @@ class Country(object):
         self.denominations = denominations or []
         # Inventory of CurrencyPieces for this country.
         self.inventory = inventory or []
+        # How many bytes of the country's journal have been replayed into the
+        # inventory.  Anything after that was added by someone else since
+        # this country was loaded, and gets folded in when it's saved.
+        self.journal_offset = 0
+        # What was stored for this country when it was loaded (see
+        # `stored_version`), so that `save` can tell whether anyone else has
+        # saved it since.  None for a country that wasn't loaded.
+        self.loaded_version = None
+
+    @property
+    def denominations(self):
+        return self._denominations
+
+    @denominations.setter
+    def denominations(self, denominations):
+        self._denominations = _DenominationList(denominations)
+        self._denomination_index = None
+        self._indexed_changes = 0
+
+    def _current_index(self):
+        """ The denomination index, rebuilt if the list changed since """
+        denominations = self._denominations
+        if (self._denomination_index is None or
+                self._indexed_changes != denominations.changes):
+            self._denomination_index = {denom.name: denom
+                                        for denom in denominations}
+            self._indexed_changes = denominations.changes
+        return self._denomination_index
+
+    @property
+    def denomination_index(self):
+        """ A read-only dict mapping denomination names to Denominations
+
+        Adding, removing or reordering `denominations` in place is noticed,
+        as is renaming one of them.
+        """
+        return types.MappingProxyType(self._current_index())
+
+    def add_denomination(self, denomination):
+        """ Append a denomination to this country """
+        self._denominations.append(denomination)
+
+    def find_denomination(self, denom_name):
+        """ Like `get_denomination`, but return None if it's not found """
+        denom = self._current_index().get(denom_name)
+        if denom is not None and denom.name != denom_name:
+            # Renamed since it was indexed
+            self._denomination_index = None
+            denom = self._current_index().get(denom_name)
+        return denom
 
     def get_denomination(self, denom_name):
         """ Given the name of a denomination for this country, return it """
-        for denom in self.denominations:
-            if denom_name == denom.name:
-                return denom
-        else:  # pylint: disable=W0120
+        denom = self.find_denomination(denom_name)
+        if denom is None:
             raise KeyError("Denomination '%s' not found" % denom_name)
+        return denom
+
+    def has_subunit(self, denom_name, subunit):
+        """ Whether a denomination of this country exists and has a subunit """
+        denom = self.find_denomination(denom_name)
+        return denom is not None and subunit in denom.subunit_set
 
     def validate(self):
         """ Validates the data in a country object.
@@ -40,16 +105,31 @@ class Country(object):
 
         We do not check types.  That would add lots of boilerplate.
         """
-        assert self.short_name, "Missing short name"
-        assert len(self.denominations), "Must have at least one denomination"
-        for denom in self.denominations:
-            denom.validate()
-        for piece in self.inventory:
-            piece.validate()
-            # Ensure that the piece's denomination exists
-            denom = self.get_denomination(piece.denomination)
-            assert piece.subunit in denom.subunits, (
-                "Piece's subunit not in denomination")
+        with profiling.span("Country.validate"):
+            assert self.short_name, "Missing short name"
+            assert len(self.denominations), (
+                "Must have at least one denomination")
+            for denom in self.denominations:
+                denom.validate()
+            # Look up each denomination's subunits once, not once per piece
+            subunit_sets = {denom.name: denom.subunit_set
+                            for denom in self.denominations}
+            for piece in self.inventory:
+                piece.validate()
+                subunit_set = subunit_sets.get(piece.denomination)
+                if subunit_set is None:
+                    raise KeyError("Denomination '%s' not found" %
+                                   piece.denomination)
+                assert piece.subunit in subunit_set, (
+                    "Piece's subunit not in denomination")
+
+    def validate_piece(self, piece):
+        """ Validates one piece and makes sure it fits this country """
+        piece.validate()
+        # Ensure that the piece's denomination exists
+        denom = self.get_denomination(piece.denomination)
+        assert piece.subunit in denom.subunit_set, (
+            "Piece's subunit not in denomination")
 
     @classmethod
     def from_dict(cls, dictionary):
@@ -67,47 +147,880 @@ class Country(object):
                     denominations=denominations,
                     inventory=inventory)
 
-    def save(self):
+    @staticmethod
+    def path(short_name):
+        return os.path.join(constants.COUNTRY_DIR, "%s.json" % short_name)
+
+    @staticmethod
+    def journal_path(short_name):
+        """ Path to a country's insert journal
+
+        The journal is a hidden file, so ``load_all`` won't mistake it for a
+        country.  It holds one JSON-serialized `CurrencyPiece` per line.
+        """
+        return os.path.join(constants.COUNTRY_DIR,
+                            ".%s.journal" % short_name)
+
+    def serialize(self, compact=False):
+        """ Return the contents of this country's data file, as a string
+
+        The output is canonical, so that saving an unchanged country gives
+        the same bytes and diffs only show real changes.  Keys are sorted,
+        except that the inventory comes last so that `stream` can read the
+        header first, and the inventory is ordered by `inventory_sort_key`.
+
+        :param compact:  Leave out all optional whitespace
+        """
+        return ''.join(self.iter_serialized(
+            sorted(self.inventory, key=self.inventory_sort_key()), compact))
+
+    def inventory_sort_key(self):
+        """ Return a key function that orders pieces by denomination,
+        subunit, value and year
+
+        Denominations and subunits are ordered the way this country lists
+        them, so the most recent denomination and the largest unit come
+        first.  The remaining attributes break ties.
+        """
+        positions = {}
+        for i, denom in enumerate(self.denominations):
+            positions[denom.name] = (
+                i, {subunit: j for j, subunit in enumerate(denom.subunits)})
+        unknown = (len(positions), {})
+
+        def sort_key(piece):
+            denom_position, subunits = positions.get(piece.denomination,
+                                                     unknown)
+            return (denom_position, piece.denomination,
+                    subunits.get(piece.subunit, len(subunits)), piece.subunit,
+                    piece.value, piece.year, piece.piece_type,
+                    piece.obsolete, piece.owner)
+        return sort_key
+
+    def iter_serialized(self, pieces, compact=False):
+        """ Yield the contents of a data file for this country piece by piece
+
+        The format is the same as `serialize`, but the inventory comes from
+        `pieces` (any iterable, e.g. from `stream`) and is never all in
+        memory.  The pieces are written in the order they come in.
+        """
+        import json
+
+        header = dict(short_name=self.short_name,
+                      long_name=self.long_name,
+                      denominations=[d.to_dict() for d in self.denominations])
+        if compact:
+            head = json.dumps(header, sort_keys=True, separators=(',', ':'))
+            yield head[:-len('}')] + ',"inventory":['
+        else:
+            head = json.dumps(header, sort_keys=True, indent=4)
+            yield head[:-len('\n}')] + ',\n    "inventory": ['
+        written = False
+        pieces = iter(pieces)
+        while True:
+            batch = [piece.to_dict()
+                     for piece in itertools.islice(pieces, _ENCODE_BATCH)]
+            if not batch:
+                break
+            if written:
+                yield ','
+            yield _encode_pieces(batch, compact)
+            written = True
+        if compact:
+            yield ']}'
+        else:
+            yield '\n    ]\n}' if written else ']\n}'
+
+    def save(self, compact=False):
+        """ Validate and store this country
+
+        With the default JSON storage, this writes out the country's data file
+        unless it already holds exactly what would be written.  The journal is
+        folded in and removed:  the pieces that were in it when this country
+        was loaded are already in its inventory, and any that other writers
+        added since are appended to it.  With the SQLite backend (see
+        ``storage``), the country is written to the database instead.
+
+        This holds the country's lock (see ``locks``) while it writes.  If
+        anyone else saved the country (e.g. compacted it) after it was
+        loaded, nothing is written:  that would throw away their changes.
+        Use `edit` to hold the lock from loading through saving, so that
+        can't happen.
+
+        :param compact:  Write the data file without optional whitespace
+        :returns:  Whether anything was written
+        :raises StaleCountryError:  if the stored country changed since this
+                                    one was loaded
+        """
+        import cache
+        import locks
+
         self.validate()
-        path = os.path.join(constants.COUNTRY_DIR, "%s.json" % self.short_name)
-        # Serialize before opening the file.  That way if serialization fails,
-        # we don't truncate the file
-        json_serialized = json.dumps(self.to_dict(), indent=4)
-        with open(path, 'w') as json_file:
-            json_file.write(json_serialized)
+        database = _database()
+        if database is not None:
+            version = self.loaded_version
+            version, written = database.save(
+                self, expected_version=version[1]
+                if version and version[0] == 'sqlite' else None)
+            self.loaded_version = ('sqlite', version)
+            if written:
+                cache.invalidate(self.short_name)
+            return written
+        with locks.country_lock(self.short_name):
+            # Finish an append that was interrupted, so its pieces are folded
+            # in below
+            self._finish_commit(self.short_name)
+            self._remove_spool_dir(self.short_name)
+            self._check_not_stale()
+            written = self.write_json(compact=compact)
+            self.loaded_version = self.stored_version(self.short_name)
+            return written
+
+    def _check_not_stale(self):
+        """ Raise `StaleCountryError` if someone else saved this country's
+        JSON data file, or replaced its journal, since it was loaded
+        """
+        loaded = self.loaded_version
+        if loaded is None or loaded[0] != 'json':
+            return
+        try:
+            current = self.stored_version(self.short_name)
+        except FileNotFoundError:
+            current = None
+        # Pieces appended to the same journal are fine:  they get folded in.
+        # A journal that's new since loading is read from the start.
+        if (current is None or current[1] != loaded[1] or
+                loaded[2] is not None and current[2] != loaded[2]):
+            raise StaleCountryError(
+                "%s was changed by someone else after it was loaded" %
+                self.short_name)
 
     @classmethod
-    def load(cls, short_name):
-        path = os.path.join(constants.COUNTRY_DIR, "%s.json" % short_name)
+    def stored_version(cls, short_name):
+        """ Identify what's stored for a JSON country right now
+
+        This is the ``os.stat`` of the data file and the inode of the journal
+        (or None), so it changes whenever the country is saved or compacted,
+        but not when pieces are appended to its journal.
+
+        :raises FileNotFoundError:  if the data file is missing
+        """
+        stat = os.stat(cls.path(short_name))
         try:
-            with open(path, 'r') as json_file:
-                json_data = json.loads(json_file.read())
+            journal_inode = os.stat(cls.journal_path(short_name)).st_ino
+        except FileNotFoundError:
+            journal_inode = None
+        return ('json', (stat.st_ino, stat.st_mtime_ns, stat.st_size),
+                journal_inode)
+
+    @classmethod
+    def edit(cls, short_name, compact=False):
+        """ Load a country for a ``with`` block and save it afterwards, while
+        holding its lock the whole time::
+
+            with models.Country.edit('canada') as canada:
+                canada.inventory.append(piece)
+
+        Nothing is saved if the block raises an exception.
+        """
+        import contextlib
+        import locks
+
+        @contextlib.contextmanager
+        def editing():
+            with locks.country_lock(short_name):
+                country = cls.load(short_name)
+                yield country
+                country.save(compact)
+        return editing()
+
+    def write_json(self, pieces=None, compact=False):
+        """ Write this country's JSON data file and remove its journal
+
+        This doesn't validate and ignores the configured backend.  Use `save`.
+
+        :param pieces:  An iterable of pieces to write instead of the
+                        inventory.  They're written as they come, to a
+                        temporary file that replaces the data file at the end.
+        :param compact:  Leave out all optional whitespace
+        :returns:  Whether the data file was written.  It isn't if it already
+                   has the same contents and there's no journal to fold in.
+
+        The file is written to a temporary file and renamed into place, so a
+        crash never leaves a truncated data file behind.  The directory is
+        synced after the rename, so a crash can't lose it either.
+        """
+        import cache
+
+        path = self.path(self.short_name)
+        journal_path = self.journal_path(self.short_name)
+        if pieces is not None:
+            chunks = self.iter_serialized(pieces, compact)
+        else:
+            self._fold_in_journal()
+            with profiling.span("Country.serialize"):
+                json_serialized = self.serialize(compact).encode('utf-8')
+            if (not os.path.exists(journal_path) and
+                    _file_digest(path) == cache.content_digest(
+                        json_serialized)):
+                profiling.count("Country.save skipped")
+                return False
+            chunks = [json_serialized]
+        tmp_path = os.path.join(os.path.dirname(path), ".%s.%d.tmp" % (
+            os.path.basename(path), os.getpid()))
+        try:
+            with profiling.span("Country.save write"):
+                with open(tmp_path, 'wb') as json_file:
+                    for chunk in chunks:
+                        json_file.write(chunk if isinstance(chunk, bytes)
+                                        else chunk.encode('utf-8'))
+                    json_file.flush()
+                    os.fsync(json_file.fileno())
+            os.replace(tmp_path, path)
+            # The new data file has to be on disk before the journal is gone
+            _fsync_dir(os.path.dirname(path))
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        try:
+            os.remove(journal_path)
+        except FileNotFoundError:
+            pass
+        else:
+            _fsync_dir(os.path.dirname(journal_path))
+        self.journal_offset = 0
+        cache.invalidate(self.short_name)
+        return True
+
+    def _fold_in_journal(self):
+        """ Append the pieces that other writers journaled since this country
+        was loaded
+        """
+        try:
+            with open(self.journal_path(self.short_name), 'rb') as journal:
+                journal.seek(self.journal_offset)
+                journal_data = journal.read()
+        except FileNotFoundError:
+            return
+        offset = self.journal_offset
+        self.replay_journal(journal_data)
+        self.journal_offset += offset
+
+    @classmethod
+    def append_to_journal(cls, short_name, pieces):
+        """ Record new pieces for a country without rewriting its data file
+
+        This costs the same no matter how big the country's inventory is.  The
+        pieces show up whenever the country is loaded, and are folded into the
+        data file the next time it's saved (see ``compact.py``).  The caller is
+        responsible for validating the pieces.
+
+        With the SQLite backend, the pieces go straight into the database.
+
+        Appends are group committed.  Each writer first drops its pieces into
+        the country's spool directory, then takes the country's lock.
+        Whoever gets the lock appends everything in the spool to the journal
+        with one write and one fsync.  A writer that was queued behind it
+        finds its pieces already written and returns without writing.
+        """
+        import cache
+        import locks
+
+        database = _database()
+        if database is not None:
+            # The lock keeps this out of the middle of an `edit`
+            with locks.country_lock(short_name):
+                database.append_pieces(short_name, pieces)
+            cache.invalidate(short_name)
+            return
+
+        import json
+        import threading
+
+        lines = ''.join(json.dumps(piece.to_dict()) + '\n' for piece in pieces)
+        spool_dir = cls.spool_dir(short_name)
+        # Name entries so that they sort in the order they were spooled
+        entry = os.path.join(spool_dir, "%020d-%d-%d.pending" % (
+            time.time_ns(), os.getpid(), threading.get_ident()))
+        while True:
+            os.makedirs(spool_dir, exist_ok=True)
+            try:
+                entry_file = open(entry + ".tmp", 'w')
+            except FileNotFoundError:
+                # A flush removed the spool directory once it was empty
+                continue
+            with entry_file:
+                entry_file.write(lines)
+            break
+        os.replace(entry + ".tmp", entry)
+        with locks.country_lock(short_name):
+            # Our entry may have been committed by someone who crashed before
+            # finishing, so finish their commit too
+            if (os.path.exists(entry) or
+                    os.path.exists(cls._commit_path(short_name))):
+                cls._flush_spool(short_name)
+        cache.invalidate(short_name)
+
+    @staticmethod
+    def spool_dir(short_name):
+        """ Where pieces wait to be appended to a country's journal """
+        return os.path.join(constants.COUNTRY_DIR,
+                            ".%s.pending" % short_name)
+
+    @classmethod
+    def has_journal(cls, short_name):
+        """ Whether a country has inserted pieces that its JSON data file
+        doesn't hold yet, in its journal or its spool
+        """
+        if os.path.exists(cls.journal_path(short_name)):
+            return True
+        try:
+            return bool(os.listdir(cls.spool_dir(short_name)))
+        except FileNotFoundError:
+            return False
+
+    @staticmethod
+    def _commit_path(short_name):
+        """ Where spooled pieces wait while they're appended to the journal
+        """
+        return os.path.join(Country.spool_dir(short_name), "commit")
+
+    @classmethod
+    def _flush_spool(cls, short_name):
+        """ Append every spooled entry to the journal.  Call with the
+        country's lock held.
+
+        The entries are first moved into one commit file, which also records
+        how long the journal was before the append, and then appended by
+        `_finish_commit`.  However a crash interrupts this, either the
+        entries or the commit file are left behind, and the next flush (or
+        save) appends their pieces exactly once.
+        """
+        import json
+
+        cls._finish_commit(short_name)
+        spool_dir = cls.spool_dir(short_name)
+        try:
+            filenames = sorted(filename for filename in os.listdir(spool_dir)
+                               if filename.endswith('.pending'))
+        except FileNotFoundError:
+            return
+        if not filenames:
+            cls._remove_spool_dir(short_name)
+            return
+        data = []
+        for filename in filenames:
+            with open(os.path.join(spool_dir, filename), 'r') as entry_file:
+                data.append(entry_file.read())
+        try:
+            journal_size = os.path.getsize(cls.journal_path(short_name))
+        except FileNotFoundError:
+            journal_size = 0
+        commit_path = cls._commit_path(short_name)
+        with open(commit_path + ".tmp", 'w') as commit_file:
+            commit_file.write(json.dumps(dict(journal_size=journal_size,
+                                              entries=filenames)) + '\n')
+            commit_file.write(''.join(data))
+            commit_file.flush()
+            os.fsync(commit_file.fileno())
+        os.replace(commit_path + ".tmp", commit_path)
+        _fsync_dir(spool_dir)
+        # The commit file has the pieces now
+        for filename in filenames:
+            os.remove(os.path.join(spool_dir, filename))
+        cls._finish_commit(short_name)
+        profiling.count("journal entries committed", len(filenames))
+
+    @classmethod
+    def _finish_commit(cls, short_name):
+        """ Make sure that the pieces in a country's commit file are in its
+        journal exactly once, then remove the commit file.  Call with the
+        country's lock held.
+
+        Only commits change the journal while the lock is held, so the
+        journal is exactly the recorded size plus the pieces if the append
+        finished.  If it's any shorter, whatever part of the append made it
+        is cut off and the pieces are appended again.
+        """
+        import json
+
+        commit_path = cls._commit_path(short_name)
+        try:
+            with open(commit_path, 'r') as commit_file:
+                commit = json.loads(commit_file.readline())
+                data = commit_file.read().encode('utf-8')
+        except FileNotFoundError:
+            return
+        spool_dir = cls.spool_dir(short_name)
+        for filename in commit['entries']:
+            try:
+                os.remove(os.path.join(spool_dir, filename))
+            except FileNotFoundError:
+                pass
+        journal_path = cls.journal_path(short_name)
+        created = not os.path.exists(journal_path)
+        with profiling.span("journal group commit"):
+            with open(journal_path, 'ab') as journal_file:
+                size = journal_file.seek(0, os.SEEK_END)
+                if size < commit['journal_size'] + len(data):
+                    journal_file.truncate(min(size, commit['journal_size']))
+                    journal_file.write(data)
+                    journal_file.flush()
+                    os.fsync(journal_file.fileno())
+            if created:
+                _fsync_dir(os.path.dirname(journal_path))
+        os.remove(commit_path)
+        cls._remove_spool_dir(short_name)
+
+    @classmethod
+    def _remove_spool_dir(cls, short_name):
+        """ Remove a country's spool directory if it's empty.  Call with the
+        country's lock held.
+
+        Writers that are spooling without the lock just create it again.
+        """
+        try:
+            os.rmdir(cls.spool_dir(short_name))
+        except OSError:
+            # Missing, or somebody's entries are in it
+            pass
+
+    def replay_journal(self, journal_data):
+        """ Append the pieces recorded in a journal to this country's inventory
+
+        A crash in the middle of an append can leave a partial last line.
+        Only complete lines are replayed.
+        """
+        import json
+
+        if isinstance(journal_data, str):
+            journal_data = journal_data.encode('utf-8')
+        self.journal_offset = journal_data.rfind(b'\n') + 1
+        journal_data = journal_data.decode('utf-8')
+        for line in journal_data.split('\n')[:-1]:
+            if line.strip():
+                self.inventory.append(CurrencyPiece.from_dict(
+                    json.loads(line)))
+
+    @classmethod
+    def parse(cls, json_data, journal_data=None):
+        """ Build a country from the raw contents of its data file and journal
+        """
+        import json
+
+        with profiling.span("json.loads"):
+            dictionary = json.loads(json_data)
+        with profiling.span("Country.from_dict"):
+            country = cls.from_dict(dictionary)
+        if journal_data:
+            with profiling.span("Country.replay_journal"):
+                country.replay_journal(journal_data)
+        return country
+
+    @classmethod
+    def load(cls, short_name, columnar=False):
+        """ Load a country from the configured backend
+
+        :param columnar:  Give the country an `inventory.ColumnarInventory`,
+                          with its grouped sums already worked out.  That's
+                          quicker to total, and slower to do anything else
+                          with.
+        """
+        database = _database()
+        if database is not None:
+            country = database.load(short_name)
+            if country is None:
+                print("Could not find country data for %s in %s" %
+                      (short_name, constants.SQLITE_PATH))
+                sys.exit(1)
+            return cls._columnar(country) if columnar else country
+        try:
+            return cls.load_json(short_name, columnar)
         except IOError as e:
             if e.errno == 2:
                 print("Could not find country data for %s in %s" %
                       (short_name, constants.COUNTRY_DIR))
                 sys.exit(1)
             raise
-        return cls.from_dict(json_data)
 
     @classmethod
-    def load_all(cls):
+    def stream(cls, short_name):
+        """ Read a country's header now and its inventory one piece at a time
+
+        Unlike `load`, this never holds the whole inventory in memory, so it
+        suits anything that looks at each piece once (totals, counts,
+        exports).  The pieces come from the data file first and then from
+        the journal, in the order `load` would put them in.
+
+        :returns:  A tuple of the country without any inventory, and an
+                   iterator of its `CurrencyPiece` objects
+        """
+        database = _database()
+        if database is not None:
+            country = database.load(short_name, pieces=False)
+            if country is None:
+                raise KeyError(short_name)
+            return country, database.iter_pieces(short_name)
+        return cls.stream_json(short_name)
+
+    @classmethod
+    def stream_json(cls, short_name):
+        """ Like `stream`, but always from the JSON data file and journal,
+        whatever the backend
+        """
+        pieces = cls._stream_json(short_name)
+        # The first thing the generator produces is the header
+        return next(pieces), pieces
+
+    @classmethod
+    def load_header(cls, short_name):
+        """ Load a country's names and denominations, without its inventory
+
+        Only the start of the data file is read (see `stream`), so this costs
+        the same however many pieces the country has.
+        """
+        try:
+            country, pieces = cls.stream(short_name)
+        except (KeyError, FileNotFoundError):
+            print("Could not find country data for %s in %s" %
+                  (short_name, constants.SQLITE_PATH if _database()
+                   else constants.COUNTRY_DIR))
+            sys.exit(1)
+        pieces.close()
+        return country
+
+    @classmethod
+    def iter_inventory(cls, short_name):
+        """ Yield every piece of a country, without loading them all.  See
+        `stream`.
+        """
+        return cls.stream(short_name)[1]
+
+    @classmethod
+    def _stream_json(cls, short_name):
+        """ Yield a country without inventory, then each of its pieces
+
+        Saved data files have the inventory last, so they're read in one
+        pass.  A hand-edited file with the inventory before the rest of the
+        header is read twice.
+        """
+        import jsonstream
+
+        header = {}
+        header_keys = ('short_name', 'long_name', 'denominations')
+        read_again = False
+        with open(cls.path(short_name), 'r') as json_file:
+            members = jsonstream.iter_object(jsonstream.JSONStream(json_file),
+                                             stream_keys={'inventory'})
+            for key, value in members:
+                if key != 'inventory':
+                    if header is not None:
+                        header[key] = value
+                elif not all(k in header for k in header_keys):
+                    read_again = True
+                else:
+                    yield cls._header_from_dict(header)
+                    for piece_dict in value:
+                        yield CurrencyPiece.from_dict(piece_dict)
+                    header = None
+            if header is not None:
+                yield cls._header_from_dict(header)
+        if read_again:
+            with open(cls.path(short_name), 'r') as json_file:
+                members = jsonstream.iter_object(
+                    jsonstream.JSONStream(json_file),
+                    stream_keys={'inventory'})
+                for key, value in members:
+                    if key == 'inventory':
+                        for piece_dict in value:
+                            yield CurrencyPiece.from_dict(piece_dict)
+        for piece in cls._iter_journal(short_name):
+            yield piece
+
+    @classmethod
+    def _header_from_dict(cls, header):
+        return cls.from_dict(dict(header, inventory=[]))
+
+    @classmethod
+    def _iter_journal(cls, short_name):
+        """ Yield the pieces in a country's journal, like `replay_journal` """
+        import json
+
+        try:
+            journal_file = open(cls.journal_path(short_name), 'r')
+        except FileNotFoundError:
+            return
+        with journal_file:
+            for line in journal_file:
+                # A partial last line is left over from an interrupted append
+                if line.endswith('\n') and line.strip():
+                    yield CurrencyPiece.from_dict(json.loads(line))
+
+    @classmethod
+    def load_json(cls, short_name, columnar=False):
+        """ Load a country from its JSON data file, whatever the backend """
+        # Take the version first, so that a save that sneaks in while loading
+        # makes this copy look stale rather than current
+        import cache
+
+        version = cls.stored_version(short_name)
+        parse = cls.parse
+        if columnar:
+            def parse(json_data, journal_data):
+                return cls._columnar(cls.parse(json_data, journal_data))
+        country = cache.load_country(short_name, cls.path(short_name), parse,
+                                     cls.journal_path(short_name),
+                                     'columnar' if columnar else '')
+        country.loaded_version = version
+        return country
+
+    @staticmethod
+    def _columnar(country):
+        """ Switch a country to an `inventory.ColumnarInventory` """
+        import inventory
+
+        with profiling.span("ColumnarInventory.from_pieces"):
+            columns = inventory.ColumnarInventory.from_pieces(
+                country.inventory)
+            # Now, so that they're in the on-disk cache too
+            columns.sums()
+        country.inventory = columns
+        return country
+
+    @classmethod
+    def exists(cls, short_name):
+        database = _database()
+        if database is not None:
+            return database.exists(short_name)
+        return os.path.exists(cls.path(short_name))
+
+    @classmethod
+    def digest(cls, short_name):
+        """ A string that changes whenever a country's stored data changes """
+        import cache
+
+        database = _database()
+        if database is not None:
+            return database.digest(short_name)
+        return cache.file_digest(cls.path(short_name),
+                                 cls.journal_path(short_name))
+
+    @classmethod
+    def stamp(cls, short_name):
+        """ Like `digest`, but cheap enough to check on every request
+
+        Nothing is read:  with JSON storage this is the ``os.stat`` of the
+        data file and journal, so any save, insert or compaction changes it.
+
+        :raises FileNotFoundError:  if the country's data file is missing
+        :raises KeyError:  if the country isn't in the database
+        """
+        database = _database()
+        if database is not None:
+            return database.digest(short_name)
+        stat = os.stat(cls.path(short_name))
+        try:
+            journal = os.stat(cls.journal_path(short_name))
+        except FileNotFoundError:
+            journal_key = None
+        else:
+            journal_key = (journal.st_ino, journal.st_mtime_ns,
+                           journal.st_size)
+        return ((stat.st_ino, stat.st_mtime_ns, stat.st_size), journal_key)
+
+    @classmethod
+    def load_cached(cls, short_name):
+        """ Load a country, reusing the copy loaded earlier in this process
+
+        This is meant for countries that get looked up over and over, like the
+        Eurozone.  The same object is returned every time, so don't modify it.
+        """
+        import cache
+
+        country = cache.COUNTRIES.get(short_name)
+        if country is None:
+            country = cls.load(short_name)
+            cache.COUNTRIES.put(short_name, country)
+        return country
+
+    @classmethod
+    def load_all(cls, columnar=False):
         """ For every file in the country data dir, load the country and return
         them all in a list
+
+        Countries whose data files (and journals) haven't changed since the
+        last run are loaded from the on-disk cache instead of being re-parsed.
+        See the ``cache`` module.
+
+        :param columnar:  See `load`
         """
-        countries = []
-        for filename in os.listdir(constants.COUNTRY_DIR):
+        database = _database()
+        if database is not None:
+            countries = database.load_all()
+            if columnar:
+                countries = [cls._columnar(c) for c in countries]
+            return countries
+        return [cls.load(short_name, columnar)
+                for short_name in cls.list_all()]
+
+    @staticmethod
+    def list_all():
+        """ List the short name of every country """
+        database = _database()
+        if database is not None:
+            return database.list_all()
+        return Country.list_json()
+
+    @staticmethod
+    def list_json():
+        """ List the short name of every country in the country data dir """
+        short_names = []
+        with profiling.span("os.listdir"):
+            filenames = os.listdir(constants.COUNTRY_DIR)
+        for filename in filenames:
             # Ignore hidden files -- vim creates hidden temporary swap files
             if filename.startswith('.'):
                 continue
             # Strip the ".json" suffix
-            short_name = filename[:-5]
-            countries.append(cls.load(short_name))
-        return countries
+            short_names.append(filename[:-5])
+        return short_names
+
+
+# How many pieces `Country.iter_serialized` encodes at once
+_ENCODE_BATCH = 1024
+# The separator between the members of a piece in an indented data file
+_PIECE_SEPARATOR = ",\n            "
+
+
+def _encode_pieces(piece_dicts, compact):
+    """ Encode some pieces as they appear in a data file's inventory, without
+    the brackets around the inventory
+
+    ``json.dumps`` only uses the C encoder when it isn't indenting, and the
+    pure Python one is several times slower.  The pieces are flat, so they're
+    encoded without indentation, with the newline and indent of an indented
+    file as the separator between their members, and then each piece's
+    braces are moved onto their own lines.  That gives exactly what
+    ``json.dumps(..., indent=4)`` would.
+    """
+    import json
+
+    if compact:
+        return json.dumps(piece_dicts, sort_keys=True,
+                          separators=(',', ':'))[1:-1]
+    encoded = json.dumps(piece_dicts, sort_keys=True,
+                         separators=(_PIECE_SEPARATOR, ': '))
+    # No string in a piece can contain a raw newline, so the only place that
+    # this appears is between two pieces
+    between = "}" + _PIECE_SEPARATOR + "{"
+    return ("\n        {\n            " +
+            encoded[2:-2].replace(between,
+                                  "\n        },\n        {\n            ") +
+            "\n        }")
+
+
+def _file_digest(path):
+    import cache
+
+    try:
+        return cache.file_digest(path)
+    except FileNotFoundError:
+        return None
+
+
+def _fsync_dir(path):
+    """ Make the creation, renaming and removal of files in a directory
+    durable, like ``os.fsync`` does for the contents of a file
+
+    Some platforms (like Windows) can't open a directory, and don't need to.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _database():
+    """ The `storage.Database` countries are stored in, or None if they're
+    stored in JSON files
+
+    ``storage`` (and sqlite3) is only imported when it's in use.
+    """
+    if constants.STORAGE_BACKEND != 'sqlite':
+        return None
+    import storage
+
+    return storage.database()
+
+
+def _intern(value):
+    """ Intern strings, so that every piece shares one copy of "coin", "cents"
+    and so on.  Anything else is returned unchanged.
+    """
+    return sys.intern(value) if type(value) is str else value
+
+
+class _DenominationList(list):
+    """ A country's list of denominations, which counts its own changes
+
+    `Country` keeps an index of its denominations by name, and checks
+    ``changes`` to know when to rebuild it.
+    """
+
+    changes = 0
+
+    def _changed(self):
+        self.changes += 1
+
+    def _counts_changes(method):  # pylint: disable=E0213
+        def changing(self, *args):
+            result = method(self, *args)
+            self._changed()
+            return result
+        changing.__name__ = method.__name__
+        changing.__doc__ = method.__doc__
+        return changing
+
+    append = _counts_changes(list.append)
+    extend = _counts_changes(list.extend)
+    insert = _counts_changes(list.insert)
+    remove = _counts_changes(list.remove)
+    pop = _counts_changes(list.pop)
+    clear = _counts_changes(list.clear)
+    reverse = _counts_changes(list.reverse)
+    __setitem__ = _counts_changes(list.__setitem__)
+    __delitem__ = _counts_changes(list.__delitem__)
+    __iadd__ = _counts_changes(list.__iadd__)
+    __imul__ = _counts_changes(list.__imul__)
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self._changed()
+
+    del _counts_changes
+
+
+# Every denomination built by `Denomination.from_dict` that's still in use,
+# keyed by its definition
+_SHARED_DENOMINATIONS = weakref.WeakValueDictionary()
 
 
 class CurrencyPiece(object):
-    """ Class to represent one piece of currency:  a bill or a coin """
+    """ Class to represent one piece of currency:  a bill or a coin
+
+    A big collection has millions of these, so they have ``__slots__`` instead
+    of a ``__dict__`` and their string attributes are interned.
+    """
+
+    __slots__ = ('piece_type', 'obsolete', 'denomination', 'value', 'subunit',
+                 'year', 'owner')
 
     def __init__(self,
                  piece_type='bill',
@@ -118,23 +1031,23 @@ class CurrencyPiece(object):
                  year=0,
                  owner="Joel Friedly"):
         # Either the string "bill" or "coin"
-        self.piece_type = piece_type
+        self.piece_type = _intern(piece_type)
         # A boolean indicating whether or not this piece is obsolete
         self.obsolete = obsolete
         # The country-unique name for the denomination this piece belongs to
         # Ex:  "pesos ley" or "pesos argentino", but *not* "pesos"
-        self.denomination = denomination
+        self.denomination = _intern(denomination)
         # The face value of this piece, usually an integer
         # Ex:  a dime would have a value of 10 and a subunit of "cents"
         self.value = value
         # The subunit this piece is valued in terms of
         # Ex:  a dime would have a value of 10 and a subunit of "cents"
-        self.subunit = subunit
+        self.subunit = _intern(subunit)
         # The year that this piece was printed/minted, if available
         self.year = year
         # The owner of this piece (a few pieces in my collection aren't
         # actually mine)
-        self.owner = owner
+        self.owner = _intern(owner)
 
     def validate(self):
         """ Validate a piece of currency
@@ -224,8 +1137,45 @@ class Denomination(object):
     `Denomination`_ object.
 
         total(australia, desired_unit="pounds", count_obsolete=True)
+
+    Conversion factors
+    ------------------
+
+    Walking the divisions chain every time we want to add up some currency is
+    wasteful, so each denomination flattens it once into `factors`:  a dict
+    mapping every subunit to its exact value (as a ``Fraction``) in terms of
+    the principal unit.  For pre-decimal Australian pounds that is::
+
+        {"pounds": 1, "shillings": 1/20, "pence": 1/240}
+
+    The factors are recomputed whenever `divisions` or `subunits` is
+    reassigned.  If you modify the divisions dict in place, call
+    `clear_factors` afterwards.
+
+    Sharing
+    -------
+
+    Countries that share a currency have identical denominations.
+    `from_dict` (which is how denominations are loaded) returns one shared
+    object for every identical definition, so changing it for one country
+    would change it for all of them.  Shared denominations are read-only:
+    their subunits are a tuple, their divisions are read-only mappings, and
+    assigning to their attributes raises ``AttributeError``.  To change a
+    country's denomination, replace it with a `copy`::
+
+        country.denominations[0] = country.denominations[0].copy(
+            obsolete=True)
     """
 
+    __slots__ = ('name', 'code', 'obsolete', '_subunits', '_divisions',
+                 '_factors', '_conversions', '_subunit_set', '_shared',
+                 '__weakref__')
+
+    # What can't be assigned to once a denomination is shared
+    _READ_ONLY = frozenset(['name', 'code', 'obsolete', 'subunits',
+                            'divisions', '_subunits', '_divisions',
+                            '_shared'])
+
     def __init__(self,
                  name='',
                  code='',
@@ -234,9 +1184,9 @@ class Denomination(object):
                  obsolete=False):
         # A country-unique name for this denomination.
         # Ex:  "pesos ley" or "pesos argentino", but *not* "pesos"
-        self.name = name
+        self.name = _intern(name)
         # The three-letter ISO-4217 code for this denomination, if one exists
-        self.code = code
+        self.code = _intern(code)
         # A list of the subunits of this denomination, sorted from largest
         # value to smallest.  Ex: ['pesos', 'centavos']
         self.subunits = subunits or list()
@@ -247,6 +1197,63 @@ class Denomination(object):
         # A boolean indicating if this denomination is obsolete
         self.obsolete = obsolete
 
+    def __setattr__(self, name, value):
+        if name in self._READ_ONLY and getattr(self, '_shared', False):
+            raise AttributeError(
+                "Denomination '%s' is shared, so %s can't be changed.  "
+                "Replace it with a copy instead." % (self.name, name))
+        object.__setattr__(self, name, value)
+
+    @property
+    def subunits(self):
+        return self._subunits
+
+    @subunits.setter
+    def subunits(self, subunits):
+        self._subunits = subunits
+        self.clear_factors()
+
+    @property
+    def divisions(self):
+        return self._divisions
+
+    @divisions.setter
+    def divisions(self, divisions):
+        self._divisions = divisions
+        self.clear_factors()
+
+    def clear_factors(self):
+        """ Forget the cached conversion factors and subunit set """
+        self._factors = None
+        self._conversions = None
+        self._subunit_set = None
+
+    @property
+    def subunit_set(self):
+        """ The subunits of this denomination as a frozenset, for lookups """
+        if self._subunit_set is None:
+            self._subunit_set = frozenset(self.subunits)
+        return self._subunit_set
+
+    @property
+    def factors(self):
+        """ A dict mapping each subunit to its value in the principal unit
+        """
+        if self._factors is None:
+            self._factors = division_factors(self.divisions, self.subunits[0])
+        return self._factors
+
+    def conversion(self, from_unit, to_unit=None):
+        """ Return how many `to_unit` there are in one `from_unit`
+
+        :param to_unit:  Defaults to the principal unit.
+        """
+        if self._conversions is None:
+            factors = self.factors
+            self._conversions = {(small, big): factors[small] / factors[big]
+                                 for small in factors for big in factors}
+        return self._conversions[(from_unit, to_unit or self.subunits[0])]
+
     def validate(self):
         """ Validate a denomination
 
@@ -280,11 +1287,75 @@ class Denomination(object):
 
     @classmethod
     def from_dict(cls, dictionary):
-        return cls(**dictionary)
+        """ Build a denomination, or return the loaded one with the same
+        definition
+        """
+        denomination = cls(**dictionary)
+        denomination._freeze()
+        return _SHARED_DENOMINATIONS.setdefault(denomination.definition(),
+                                                denomination)
+
+    def _freeze(self):
+        """ Make this denomination read-only, so that it can be shared """
+        self._subunits = tuple(self._subunits)
+        self._divisions = types.MappingProxyType(
+            {unit: types.MappingProxyType(dict(breakdown))
+             for unit, breakdown in self._divisions.items()})
+        self._shared = True
+
+    def copy(self, **changes):
+        """ A new denomination that isn't shared, and so can be changed
+
+        :param changes:  Attributes to change in the copy
+        """
+        dictionary = self.to_dict()
+        dictionary.update(changes)
+        return Denomination(**dictionary)
+
+    def definition(self):
+        """ Everything about this denomination, as a hashable tuple """
+        return (self.name, self.code, tuple(self.subunits),
+                tuple(sorted((unit, tuple(sorted(breakdown.items())))
+                             for unit, breakdown in self.divisions.items())),
+                self.obsolete)
+
+    def __reduce__(self):
+        # Unpickled denominations are shared too
+        return (Denomination.from_dict, (self.to_dict(),))
 
     def to_dict(self):
         return dict(name=self.name,
                     code=self.code,
-                    subunits=self.subunits,
-                    divisions=self.divisions,
+                    subunits=list(self.subunits),
+                    divisions={unit: dict(breakdown) for unit, breakdown
+                               in self.divisions.items()},
                     obsolete=self.obsolete)
+
+
+def division_factors(divisions, principal):
+    """ Flatten a divisions chain into the value of each unit in `principal`
+
+    See the docstring for `Denomination` for the divisions data structure.
+
+    :returns:  A dict mapping each unit reachable from `principal` to a
+               ``Fraction`` giving its value in terms of `principal`
+    """
+    from fractions import Fraction
+
+    factors = {}
+    unit = principal
+    factor = Fraction(1)
+    while True:
+        breakdown = divisions[unit]
+        factors[unit] = factor
+        # Stop when we hit a unit which is subdivided by one of itself
+        if breakdown['subunit'] == unit:
+            if breakdown['value'] != 1:
+                raise ValueError(
+                    "Denomination '%s' is broken down into %s %s!" %
+                    (unit, breakdown['value'], breakdown['subunit']))
+            return factors
+        factor /= Fraction(breakdown['value'])
+        unit = breakdown['subunit']
+        if unit in factors:
+            raise ValueError("Divisions loop back to '%s'" % unit)
@@ -0,0 +1,161 @@
+""" Optional timing spans and counters for the hot paths
+
+Profiling is off by default.  Turn it on by setting ``CURRENCY_PROFILE=1`` in
+the environment, passing ``--profile`` to a script that supports it, or
+calling `enable`.  When it's on, a table of every span and counter is printed
+to stderr when the process exits, and a Chrome trace (load it in
+chrome://tracing or https://ui.perfetto.dev) is written to
+``CURRENCY_PROFILE_TRACE`` or to ``profile-trace.json`` in the cache dir.
+
+Code being measured looks like this::
+
+    with profiling.span("json.loads"):
+        data = json.loads(text)
+    profiling.count("cache.hit")
+
+    @profiling.timed("total")
+    def total(country, ...):
+
+When profiling is off, `span` returns one shared do-nothing context manager
+and `count` returns immediately, so the cost is a function call and a global
+lookup.  Nothing that's only needed for profiling (threading, json) is
+imported until it's turned on, because every script imports this module.
+Spans go around whole files and whole countries, never single pieces.
+"""
+import functools
+import os
+import sys
+import time
+
+import constants
+
+ENABLED = False
+# (name, start, duration, thread id) for every finished span
+_SPANS = []
+_COUNTERS = {}
+_TRACE_PATH = []
+
+
+class _NullSpan(object):
+    """ What `span` returns when profiling is off """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        import threading
+
+        _SPANS.append((self.name, self.start,
+                       time.perf_counter() - self.start,
+                       threading.get_ident()))
+        return False
+
+
+def span(name):
+    """ Time a block of code under `name`, if profiling is on """
+    if not ENABLED:
+        return _NULL_SPAN
+    return _Span(name)
+
+
+def timed(name):
+    """ Decorator that wraps every call of a function in a `span` """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return function(*args, **kwargs)
+            with _Span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, amount=1):
+    """ Add to the counter `name`, if profiling is on """
+    if ENABLED:
+        _COUNTERS[name] = _COUNTERS.get(name, 0) + amount
+
+
+def enable(trace_path=None):
+    """ Turn profiling on and report when the process exits """
+    import atexit
+
+    global ENABLED  # pylint: disable=W0603
+    if ENABLED:
+        return
+    ENABLED = True
+    _TRACE_PATH.append(trace_path or os.environ.get(
+        'CURRENCY_PROFILE_TRACE') or os.path.join(constants.CACHE_DIR,
+                                                  "profile-trace.json"))
+    atexit.register(_report)
+
+
+def summary():
+    """ Format every span and counter recorded so far as a table """
+    stats = {}
+    for name, _, duration, _ in _SPANS:
+        calls, total, longest = stats.get(name, (0, 0.0, 0.0))
+        stats[name] = (calls + 1, total + duration, max(longest, duration))
+    lines = ["%-32s %8s %10s %10s %10s" % ("span", "calls", "total ms",
+                                            "mean ms", "max ms")]
+    for name, (calls, total, longest) in sorted(stats.items(),
+                                                key=lambda item: -item[1][1]):
+        lines.append("%-32s %8d %10.2f %10.3f %10.3f" %
+                     (name, calls, total * 1000, total * 1000 / calls,
+                      longest * 1000))
+    if _COUNTERS:
+        lines.append('')
+        lines.append("%-32s %8s" % ("counter", "value"))
+        for name, value in sorted(_COUNTERS.items()):
+            lines.append("%-32s %8d" % (name, value))
+    return '\n'.join(lines)
+
+
+def export_trace(path):
+    """ Write every span as a Chrome trace event file """
+    import json
+
+    pid = os.getpid()
+    events = [dict(name=name, ph="X", ts=start * 1e6, dur=duration * 1e6,
+                   pid=pid, tid=tid)
+              for name, start, duration, tid in _SPANS]
+    if _SPANS:
+        end = max(start + duration for _, start, duration, _ in _SPANS)
+        events.extend(dict(name=name, ph="C", ts=end * 1e6, pid=pid,
+                           args={name: value})
+                      for name, value in _COUNTERS.items())
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as trace_file:
+        json.dump(dict(traceEvents=events, displayTimeUnit="ms"), trace_file)
+
+
+def _report():
+    print(summary(), file=sys.stderr)
+    try:
+        export_trace(_TRACE_PATH[0])
+        print("Wrote trace to %s" % _TRACE_PATH[0], file=sys.stderr)
+    except OSError as e:
+        print("Could not write trace:  %s" % e, file=sys.stderr)
+
+
+if os.environ.get('CURRENCY_PROFILE', '') not in ('', '0'):
+    enable()
@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+""" Ask questions of every piece in the collection at once
+
+`total.total` answers one question:  how much of one denomination do I have?
+This module answers the rest.  It filters the pieces of every country on any
+of their attributes and groups what's left, counting the pieces, adding up
+their face values and finding the oldest and newest years::
+
+    index = query.Index(models.Country.load_all())
+    rows = index.select(piece_type='coin', obsolete=False, year_min=1990)
+    for key, stats in index.aggregate(rows, group_by=['country']).items():
+        ...
+
+or from the command line::
+
+    ./query.py --type coin --current --year-min 1990 --group-by country
+
+Building an `Index` means loading every country, so when ``server.py`` is
+running the command line asks its ``/query`` instead, which answers from an
+index the server keeps in memory.  ``--pieces`` always loads locally.
+
+An `Index` is built once, in one pass over the pieces.  Each attribute is
+stored as a column of small integer codes (like
+`inventory.ColumnarInventory`), and the first time an attribute is filtered on
+it gets an inverted index from each value to the rows that have it.  Years are
+sorted once so that year ranges are two bisections.  A query starts from the
+smallest of these row lists and checks the remaining filters against the
+columns, so it never scans rows that the most selective filter rules out.
+
+Face values are summed in the principal unit of each piece's denomination
+(via `models.Denomination.factors`), so Australian shillings and pence are
+counted as pounds.  Adding up different denominations gives a meaningless
+number, so group by ``denomination`` or ``code`` when summing.
+"""
+import argparse
+from array import array
+import bisect
+
+import inventory
+import models
+import profiling
+import total
+
+# Attributes that can be filtered and grouped on, besides ``year``
+FIELDS = ('country', 'denomination', 'code', 'piece_type', 'obsolete',
+          'subunit', 'owner')
+
+
+class Column(inventory._CodeTable):  # pylint: disable=W0212
+    """ One attribute of every piece, stored as a code per row """
+
+    def __init__(self):
+        super(Column, self).__init__()
+        self.rows = array('I')
+        self._postings = None
+
+    def append(self, name):
+        self.rows.append(self.code(name))
+
+    def postings(self):
+        """ Map each code to the rows that have it, building it on first use
+        """
+        if self._postings is None:
+            postings = [array('I') for _ in self.names]
+            for row, code in enumerate(self.rows):
+                postings[code].append(row)
+            self._postings = postings
+        return self._postings
+
+
+class Index(object):
+    """ Every piece of a list of countries, ready to be queried """
+
+    @profiling.timed("query.Index")
+    def __init__(self, countries):
+        self.columns = {field: Column() for field in FIELDS}
+        self.years = array('l')
+        # Face value in the principal unit of the piece's denomination
+        self.values = array('d')
+        self._year_order = None
+        self._sorted_years = None
+        for country in countries:
+            self.add_country(country)
+
+    def add_country(self, country):
+        columns = [self.columns[field].append for field in FIELDS]
+        (add_country, add_denomination, add_code, add_piece_type,
+         add_obsolete, add_subunit, add_owner) = columns
+        factors = {denom.name: {subunit: float(factor)
+                                for subunit, factor in denom.factors.items()}
+                   for denom in country.denominations}
+        codes = {denom.name: denom.code for denom in country.denominations}
+        for piece in country.inventory:
+            add_country(country.short_name)
+            add_denomination(piece.denomination)
+            add_code(codes[piece.denomination])
+            add_piece_type(piece.piece_type)
+            add_obsolete(piece.obsolete)
+            add_subunit(piece.subunit)
+            add_owner(piece.owner)
+            self.years.append(piece.year)
+            self.values.append(
+                piece.value * factors[piece.denomination][piece.subunit])
+        self._year_order = self._sorted_years = None
+        for column in self.columns.values():
+            column._postings = None  # pylint: disable=W0212
+
+    def __len__(self):
+        return len(self.years)
+
+    def _year_range(self, year_min, year_max):
+        """ Rows with years in [year_min, year_max], in order of year """
+        if self._year_order is None:
+            order = sorted(range(len(self)), key=self.years.__getitem__)
+            self._year_order = array('I', order)
+            self._sorted_years = array('l', (self.years[row]
+                                             for row in order))
+        low = 0
+        high = len(self)
+        if year_min is not None:
+            low = bisect.bisect_left(self._sorted_years, year_min)
+        if year_max is not None:
+            high = bisect.bisect_right(self._sorted_years, year_max)
+        return self._year_order[low:high]
+
+    @profiling.timed("query.select")
+    def select(self, year_min=None, year_max=None, **filters):
+        """ Find the pieces that match every filter
+
+        :param year_min:  Only pieces from this year or later
+        :param year_max:  Only pieces from this year or earlier
+        :param filters:  Any of `FIELDS`, mapped to one value or a list of
+                         values that a piece may have
+        :returns:  A list of row numbers, in ascending order
+        """
+        conditions = []
+        for field, wanted in filters.items():
+            if field not in self.columns:
+                raise ValueError("Can't filter on '%s'" % field)
+            if isinstance(wanted, (str, bool, int)):
+                wanted = [wanted]
+            column = self.columns[field]
+            codes = {column.codes[value] for value in wanted
+                     if value in column.codes}
+            postings = column.postings()
+            size = sum(len(postings[code]) for code in codes)
+            conditions.append((size, field, codes))
+        if year_min is not None or year_max is not None:
+            year_rows = self._year_range(year_min, year_max)
+            conditions.append((len(year_rows), 'year', year_rows))
+        if not conditions:
+            return list(range(len(self)))
+
+        # Start from the most selective filter and check the others against
+        # the columns
+        conditions.sort(key=lambda condition: condition[0])
+        _, field, start = conditions[0]
+        if field == 'year':
+            rows = sorted(start)
+        else:
+            postings = self.columns[field].postings()
+            rows = sorted(row for code in start for row in postings[code])
+        for _, field, codes in conditions[1:]:
+            if not rows:
+                break
+            if field == 'year':
+                years = self.years
+                low = -float('inf') if year_min is None else year_min
+                high = float('inf') if year_max is None else year_max
+                rows = [row for row in rows if low <= years[row] <= high]
+            else:
+                column = self.columns[field].rows
+                rows = [row for row in rows if column[row] in codes]
+        return rows
+
+    @profiling.timed("query.aggregate")
+    def aggregate(self, rows, group_by=()):
+        """ Group some rows and summarize each group
+
+        :param rows:  Row numbers, as returned by `select`
+        :param group_by:  A list of `FIELDS` and/or ``year``
+        :returns:  A dict mapping a tuple of the group's values (in the order
+                   of `group_by`) to a dict with the ``count`` of pieces, the
+                   ``sum`` of their face values, and the ``min_year`` and
+                   ``max_year`` of the pieces whose year is known (or None)
+        """
+        for field in group_by:
+            if field not in self.columns and field != 'year':
+                raise ValueError("Can't group by '%s'" % field)
+        key_columns = [self.years if field == 'year'
+                       else self.columns[field].rows for field in group_by]
+        years = self.years
+        values = self.values
+        # group key -> [count, sum, min year, max year]
+        groups = {}
+        for row in rows:
+            key = tuple(column[row] for column in key_columns)
+            year = years[row]
+            stats = groups.get(key)
+            if stats is None:
+                groups[key] = [1, values[row], year or None, year or None]
+                continue
+            stats[0] += 1
+            stats[1] += values[row]
+            # A year of 0 means that the year isn't known
+            if year:
+                if stats[2] is None or year < stats[2]:
+                    stats[2] = year
+                if stats[3] is None or year > stats[3]:
+                    stats[3] = year
+
+        names = [None if field == 'year' else self.columns[field].names
+                 for field in group_by]
+        result = {}
+        for key, (count, value_sum, min_year, max_year) in groups.items():
+            key = tuple(code if field_names is None else field_names[code]
+                        for code, field_names in zip(key, names))
+            result[key] = dict(count=count, sum=value_sum, min_year=min_year,
+                               max_year=max_year)
+        return result
+
+    def pieces(self, rows):
+        """ Describe some rows as dicts, like the pieces in a data file """
+        described = []
+        for row in rows:
+            piece = {field: column.names[column.rows[row]]
+                     for field, column in self.columns.items()}
+            piece['year'] = self.years[row]
+            piece['principal_value'] = self.values[row]
+            described.append(piece)
+        return described
+
+
+def parse_args(argv=None):
+    description = "Filter and summarize the pieces of every country"
+    argparser = argparse.ArgumentParser(description=description)
+    argparser.add_argument("--country",
+                           "-c",
+                           action="append",
+                           help="Only pieces from this country (repeatable).")
+    argparser.add_argument("--denomination",
+                           "-d",
+                           action="append",
+                           help="Only pieces of this denomination name.")
+    argparser.add_argument("--code",
+                           action="append",
+                           help="Only pieces with this ISO-4217 code.")
+    argparser.add_argument("--type",
+                           dest="piece_type",
+                           choices=["coin", "bill"],
+                           help="Only coins or only bills.")
+    obsolete = argparser.add_mutually_exclusive_group()
+    obsolete.add_argument("--obsolete",
+                          dest="obsolete",
+                          action="store_true",
+                          default=None,
+                          help="Only obsolete pieces.")
+    obsolete.add_argument("--current",
+                          dest="obsolete",
+                          action="store_false",
+                          help="Only pieces that aren't obsolete.")
+    argparser.add_argument("--subunit",
+                           action="append",
+                           help="Only pieces valued in this subunit.")
+    argparser.add_argument("--owner",
+                           action="append",
+                           help="Only pieces with this owner.")
+    argparser.add_argument("--year-min",
+                           type=int,
+                           help="Only pieces from this year or later.")
+    argparser.add_argument("--year-max",
+                           type=int,
+                           help="Only pieces from this year or earlier.")
+    argparser.add_argument("--group-by",
+                           "-g",
+                           type=lambda s: [f for f in s.split(',') if f],
+                           default=[],
+                           help=("Comma separated fields to group by:  %s or "
+                                 "year." % ', '.join(FIELDS)))
+    argparser.add_argument("--pieces",
+                           action="store_true",
+                           default=False,
+                           help="List the matching pieces instead.")
+    argparser.add_argument("--profile",
+                           required=False,
+                           default=False,
+                           action="store_true",
+                           help="Print where the time went when done.")
+    return argparser.parse_args(argv)
+
+
+def filters_from_args(args):
+    filters = {}
+    for field in FIELDS:
+        value = getattr(args, field, None)
+        if value is not None:
+            filters[field] = value
+    return filters
+
+
+def format_table(group_by, groups):
+    """ Lay out the result of `Index.aggregate` as aligned text """
+    header = list(group_by) + ['count', 'sum', 'min_year', 'max_year']
+    lines = [header]
+    for key in sorted(groups, key=lambda k: [str(v) for v in k]):
+        stats = groups[key]
+        lines.append([str(value) for value in key] + [
+            str(stats['count']), "%.2f" % stats['sum'],
+            str(stats['min_year'] or '-'), str(stats['max_year'] or '-')])
+    widths = [max(len(line[i]) for line in lines) for i in range(len(header))]
+    return '\n'.join('  '.join(cell.ljust(width)
+                               for cell, width in zip(line, widths)).rstrip()
+                     for line in lines)
+
+
+def query_daemon(args):
+    """ Ask a running server.py for the groups, like `Index.aggregate`
+
+    :returns:  The groups, or None if there's no daemon to ask
+    :raises ValueError:  if the daemon rejects the query
+    """
+    params = {}
+    for field, value in filters_from_args(args).items():
+        values = value if isinstance(value, list) else [value]
+        if field == 'obsolete':
+            values = ['1' if v else '0' for v in values]
+        if any(',' in v for v in values):
+            # The daemon splits values on commas
+            return None
+        params[field] = ','.join(values)
+    if args.year_min is not None:
+        params['year_min'] = args.year_min
+    if args.year_max is not None:
+        params['year_max'] = args.year_max
+    params['group_by'] = ','.join(args.group_by)
+    try:
+        body = total.query_daemon('/query', **params)
+    except KeyError as e:
+        raise ValueError(e.args[0])
+    if body is None:
+        return None
+    return {tuple(group[field] for field in args.group_by): group
+            for group in body}
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.profile:
+        profiling.enable()
+    try:
+        if not args.pieces:
+            groups = query_daemon(args)
+            if groups is not None:
+                print(format_table(args.group_by, groups))
+                return
+        index = Index(models.Country.load_all())
+        rows = index.select(year_min=args.year_min, year_max=args.year_max,
+                            **filters_from_args(args))
+        if args.pieces:
+            for piece in index.pieces(rows):
+                print(piece)
+            return
+        print(format_table(args.group_by,
+                           index.aggregate(rows, args.group_by)))
+    except ValueError as e:
+        raise SystemExit("query.py: %s" % e)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+""" Serve totals and inventories from memory over localhost HTTP
+
+Running ``total.py`` costs an interpreter startup and a load of the country
+data every time.  This daemon loads every country once, keeps the countries
+and all of their totals in memory, and reloads a country whenever its data
+file or journal changes (see ``catalog`` and ``watch``).  The watcher can lag
+behind a write by a moment, so every request also checks the files of the
+countries it reads (see `catalog.Catalog.refresh`) and reloads them if they
+changed.  While it runs, the daemon writes its pid and port to
+``constants.DAEMON_FILE``, and ``total.py`` asks the daemon first when that's
+there (see ``total.query_daemon``).  The port defaults to the
+``CURRENCY_DAEMON_PORT`` environment variable, or 8417.
+
+Every endpoint takes GET query parameters and answers with JSON:
+
+* ``/countries``:  the short and long name of every country
+* ``/total?country=C[&denomination=D][&obsolete=1]``:  one total, with the
+  same defaults as ``total.total``
+* ``/format?country=C[&verbose=1]`` or ``/format?all=1[&verbose=1]``:  the
+  text ``total.py`` would print
+* ``/inventory?country=C``:  the country's pieces, as in its data file
+* ``/query?[FIELD=V,...][&year_min=Y][&year_max=Y][&group_by=F,...]``:  the
+  groups that ``query.py`` would print, as a list of dicts.  The query index
+  is built on the first query and rebuilt after a reload.
+
+Errors are answered with a 4xx status and ``{"error": "..."}``.  Every
+response says where the daemon reads the collection from in its headers (see
+``total.location_headers``), so that a client using other data can tell.
+"""
+import argparse
+from http import server
+import json
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+from urllib import parse
+
+import catalog as currency_catalog
+import constants
+import total
+import watch
+
+# Other countries' files that a country's ``/format`` text depends on
+UNION_SHORT_NAMES = [union_short_name for _, union_short_name, _ in
+                     constants.SHARED_CURRENCY_UNIONS]
+
+
+def parse_args(argv=None):
+    description = "Serve currency totals from memory over localhost HTTP"
+    argparser = argparse.ArgumentParser(description=description)
+    argparser.add_argument("--port",
+                           "-p",
+                           type=int,
+                           required=False,
+                           default=constants.DAEMON_PORT,
+                           help="Port to listen on.")
+    argparser.add_argument("--interval",
+                           type=float,
+                           required=False,
+                           default=1.0,
+                           help=("Seconds between checks for changed data, "
+                                 "where inotify isn't available."))
+    return argparser.parse_args(argv)
+
+
+class RequestHandler(server.BaseHTTPRequestHandler):
+    """ Answers queries against the server's `Catalog` """
+
+    def log_message(self, format, *args):  # pylint: disable=W0622
+        # Don't print a line for every request
+        pass
+
+    def _respond(self, status, body):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for header, value in total.location_headers().items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _country(self, catalog, params, depends_on=()):
+        """ Look up the requested country, reloading it first if it changed
+
+        :param depends_on:  Other countries to check for changes too
+        """
+        short_name = params.get('country', '')
+        catalog.refresh([short_name] + list(depends_on))
+        if short_name not in catalog.countries:
+            raise KeyError("Unknown country '%s'" % short_name)
+        return catalog.countries[short_name]
+
+    def _query(self, catalog, params):
+        group_by = [f for f in params.pop('group_by', '').split(',') if f]
+        year_min = params.pop('year_min', None)
+        year_max = params.pop('year_max', None)
+        filters = {}
+        for field, value in params.items():
+            values = value.split(',')
+            if field == 'obsolete':
+                values = [v == '1' for v in values]
+            filters[field] = values
+        index = catalog.index
+        rows = index.select(year_min=year_min and int(year_min),
+                            year_max=year_max and int(year_max), **filters)
+        groups = index.aggregate(rows, group_by)
+        return [dict(zip(group_by, key), **stats)
+                for key, stats in sorted(groups.items(),
+                                         key=lambda g: [str(v) for v in g[0]])]
+
+    def do_GET(self):  # pylint: disable=C0103
+        url = parse.urlsplit(self.path)
+        params = dict(parse.parse_qsl(url.query))
+        catalog = self.server.catalog
+        try:
+            if url.path == '/countries':
+                catalog.refresh()
+                body = [dict(short_name=c.short_name, long_name=c.long_name)
+                        for c in catalog.countries.values()]
+            elif url.path == '/total':
+                country = self._country(catalog, params)
+                denomination = params.get('denomination') or None
+                obsolete = params.get('obsolete') == '1'
+                body = dict(country=country.short_name,
+                            total=total.lookup_total(catalog.totals, country,
+                                                     denomination, obsolete))
+            elif url.path == '/format':
+                verbose = params.get('verbose') == '1'
+                if params.get('all') == '1':
+                    catalog.refresh()
+                    countries = sorted(catalog.countries.values(),
+                                       key=lambda c: c.long_name)
+                else:
+                    countries = [self._country(catalog, params,
+                                               UNION_SHORT_NAMES)]
+                body = dict(text='\n'.join(
+                    total.format_country(c, verbose, totals=catalog.totals)
+                    for c in countries))
+            elif url.path == '/inventory':
+                country = self._country(catalog, params)
+                body = dict(country=country.short_name,
+                            inventory=[p.to_dict() for p in country.inventory])
+            elif url.path == '/query':
+                catalog.refresh()
+                body = self._query(catalog, params)
+            else:
+                self._respond(404, dict(error="Unknown path %s" % url.path))
+                return
+        except KeyError as e:
+            self._respond(404, dict(error=str(e.args[0])))
+            return
+        except ValueError as e:
+            self._respond(400, dict(error=str(e)))
+            return
+        self._respond(200, body)
+
+
+def watch_catalog(catalog, interval):
+    """ Reload changed countries forever.  Runs in a background thread. """
+    watcher = watch.create_watcher()
+    while True:
+        try:
+            catalog.reload(watch.wait_for_changes(watcher, interval=interval))
+        except Exception:  # pylint: disable=W0703
+            # Requests check for changes themselves, so a stale catalog is
+            # only slower.  Keep watching.
+            traceback.print_exc()
+            time.sleep(interval)
+
+
+def write_daemon_file(port):
+    """ Tell clients that this daemon is running, and on which port """
+    os.makedirs(os.path.dirname(constants.DAEMON_FILE), exist_ok=True)
+    tmp_path = "%s.%d.tmp" % (constants.DAEMON_FILE, os.getpid())
+    with open(tmp_path, 'w') as daemon_file:
+        daemon_file.write("%d %d\n" % (os.getpid(), port))
+    os.replace(tmp_path, constants.DAEMON_FILE)
+
+
+def remove_daemon_file():
+    """ Remove the daemon file, unless another daemon has replaced it """
+    try:
+        with open(constants.DAEMON_FILE, 'r') as daemon_file:
+            pid = int(daemon_file.read().split()[0])
+        if pid == os.getpid():
+            os.remove(constants.DAEMON_FILE)
+    except (OSError, ValueError, IndexError):
+        pass
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    catalog = currency_catalog.Catalog()
+    watcher = threading.Thread(target=watch_catalog,
+                               args=(catalog, args.interval),
+                               daemon=True)
+    watcher.start()
+    httpd = server.ThreadingHTTPServer(('127.0.0.1', args.port),
+                                       RequestHandler)
+    httpd.catalog = catalog
+    write_daemon_file(args.port)
+    # Clean up after a plain kill, too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print("Serving %d countries on http://127.0.0.1:%d" %
+          (len(catalog.countries), args.port))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        remove_daemon_file()
+
+
+if __name__ == "__main__":
+    main()
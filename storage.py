@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+""" SQLite storage for the collection
+
+By default every country lives in its own JSON data file in
+``constants.COUNTRY_DIR``.  That's easy to read and diff, but every load parses
+a whole file and every save rewrites one.  Setting ``CURRENCY_BACKEND=sqlite``
+in the environment stores the collection in one SQLite database at
+``constants.SQLITE_PATH`` instead.  Each piece is a row, so inserting a piece
+is a single ``INSERT`` and the pieces can be indexed by country, denomination,
+ISO-4217 code, year, type and owner.
+
+`models.Country` hides which backend is in use, so the scripts don't change.
+The JSON files stay the canonical, reviewable form of the collection.  This
+module is also a script that copies countries between the two::
+
+    ./storage.py import        # data/*.json -> database
+    ./storage.py export        # database -> data/*.json
+
+Denominations are small and always loaded as a whole, so their subunits and
+divisions are stored as JSON text.  Piece values have no declared column type
+so that SQLite keeps integers as integers and floats as floats, and exporting
+gives back exactly what was imported.
+"""
+import argparse
+import sys
+import threading
+
+import constants
+import models
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS countries (
+    short_name TEXT PRIMARY KEY,
+    long_name TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS denominations (
+    country TEXT NOT NULL REFERENCES countries (short_name),
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    code TEXT NOT NULL,
+    subunits TEXT NOT NULL,
+    divisions TEXT NOT NULL,
+    obsolete INTEGER NOT NULL,
+    PRIMARY KEY (country, position)
+);
+CREATE TABLE IF NOT EXISTS pieces (
+    id INTEGER PRIMARY KEY,
+    country TEXT NOT NULL REFERENCES countries (short_name),
+    piece_type TEXT NOT NULL,
+    obsolete INTEGER NOT NULL,
+    denomination TEXT NOT NULL,
+    code TEXT NOT NULL,
+    value NOT NULL,
+    subunit TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    owner TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pieces_country ON pieces (country);
+CREATE INDEX IF NOT EXISTS pieces_denomination
+    ON pieces (country, denomination);
+CREATE INDEX IF NOT EXISTS pieces_code ON pieces (code);
+CREATE INDEX IF NOT EXISTS pieces_year ON pieces (year);
+CREATE INDEX IF NOT EXISTS pieces_piece_type ON pieces (piece_type);
+CREATE INDEX IF NOT EXISTS pieces_owner ON pieces (owner);
+"""
+
+PIECE_COLUMNS = ('piece_type', 'obsolete', 'denomination', 'value',
+                 'subunit', 'year', 'owner')
+
+# Path -> `Database`.  Each database has one connection, shared by every
+# thread (see `Database`).
+_DATABASES = {}
+_DATABASES_LOCK = threading.Lock()
+
+
+def enabled():
+    """ Whether countries are stored in SQLite instead of JSON files """
+    return constants.STORAGE_BACKEND == 'sqlite'
+
+
+def location():
+    """ Where the collection is stored:  the database or the country data dir
+    """
+    return constants.SQLITE_PATH if enabled() else constants.COUNTRY_DIR
+
+
+def database(path=None):
+    """ Return the `Database` at `path`, opening it once per process """
+    path = path or constants.SQLITE_PATH
+    with _DATABASES_LOCK:
+        if path not in _DATABASES:
+            _DATABASES[path] = Database(path)
+        return _DATABASES[path]
+
+
+class Database(object):
+    """ A collection stored in a SQLite database
+
+    There's one connection, shared by every thread (``server.py`` answers
+    each request on its own thread).  A transaction belongs to the
+    connection, not the thread, so everything that uses the connection holds
+    ``lock`` until it's done with it.
+    """
+
+    # How many pieces `iter_pieces` reads at a time
+    BATCH_SIZE = 1024
+
+    def __init__(self, path):
+        # Most scripts never touch the database, so don't import sqlite3 until
+        # one does
+        import sqlite3
+
+        self.path = path
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+
+    def exists(self, short_name):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT 1 FROM countries WHERE short_name = ?",
+                (short_name,)).fetchone()
+        return row is not None
+
+    def list_all(self):
+        with self.lock:
+            return [row[0] for row in self.connection.execute(
+                "SELECT short_name FROM countries ORDER BY short_name")]
+
+    def digest(self, short_name):
+        """ A string that changes whenever a country is saved or inserted to
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT version FROM countries WHERE short_name = ?",
+                (short_name,)).fetchone()
+        if row is None:
+            raise KeyError(short_name)
+        return "sqlite:%d" % row[0]
+
+    def versions(self):
+        """ Map every country to its version, which goes up whenever it's
+        saved or inserted to
+        """
+        with self.lock:
+            return dict(self.connection.execute(
+                "SELECT short_name, version FROM countries"))
+
+    def load(self, short_name, pieces=True):
+        """ Load one country, or return None if it isn't in the database
+
+        :param pieces:  False to leave the inventory empty.  See
+                        `iter_pieces`.
+        """
+        countries = self._load_where("WHERE short_name = ?", (short_name,),
+                                     pieces)
+        return countries[0] if countries else None
+
+    def load_all(self):
+        """ Load every country with three queries, however many there are """
+        return self._load_where("", ())
+
+    def _load_where(self, where, params, pieces=True):
+        with self.lock:
+            return self._load_where_locked(where, params, pieces)
+
+    def _load_where_locked(self, where, params, pieces):
+        import json
+
+        countries = {}
+        for short_name, long_name, version in self.connection.execute(
+                "SELECT short_name, long_name, version FROM countries %s "
+                "ORDER BY short_name" % where, params):
+            country = models.Country(short_name=short_name,
+                                     long_name=long_name)
+            country.loaded_version = ('sqlite', version)
+            countries[short_name] = country
+        where = where.replace('short_name', 'country')
+        denominations = {short_name: [] for short_name in countries}
+        for row in self.connection.execute(
+                "SELECT country, name, code, subunits, divisions, obsolete "
+                "FROM denominations %s ORDER BY country, position" % where,
+                params):
+            denominations[row[0]].append(models.Denomination.from_dict(dict(
+                name=row[1],
+                code=row[2],
+                subunits=json.loads(row[3]),
+                divisions=json.loads(row[4]),
+                obsolete=bool(row[5]))))
+        for short_name, country in countries.items():
+            country.denominations = denominations[short_name]
+        if pieces:
+            for row in self.connection.execute(
+                    "SELECT country, %s FROM pieces %s ORDER BY id" % (
+                        ', '.join(PIECE_COLUMNS), where), params):
+                countries[row[0]].inventory.append(_piece(row[1:]))
+        return list(countries.values())
+
+    def iter_pieces(self, short_name):
+        """ Yield a country's pieces straight from a cursor
+
+        The lock is only held while reading each batch, so that other threads
+        can use the database while the pieces are being used.
+        """
+        with self.lock:
+            cursor = self.connection.execute(
+                "SELECT %s FROM pieces WHERE country = ? ORDER BY id" %
+                ', '.join(PIECE_COLUMNS), (short_name,))
+        try:
+            while True:
+                with self.lock:
+                    rows = cursor.fetchmany(self.BATCH_SIZE)
+                if not rows:
+                    return
+                for row in rows:
+                    yield _piece(row)
+        finally:
+            with self.lock:
+                cursor.close()
+
+    def save(self, country, pieces=None, expected_version=None):
+        """ Replace everything stored for a country in one transaction
+
+        Like a JSON data file, a country is only written if it changed, so
+        its version only goes up when something did.
+
+        :param pieces:  The country's pieces, if they aren't in its
+                        inventory.  Any iterable works, e.g. from
+                        `models.Country.stream`.  Pieces passed this way
+                        are always written.
+        :param expected_version:  If given, only save if the country's
+                                  version is still this one
+        :returns:  A tuple of the country's version after saving, and
+                   whether anything was written
+        :raises models.StaleCountryError:  if the version isn't
+                                           `expected_version`
+        """
+        import json
+
+        short_name = country.short_name
+        with self.lock, self.connection:
+            # Take the write lock before looking at what's stored, so that
+            # nobody can change it between the checks and the save
+            self.connection.execute("BEGIN IMMEDIATE")
+            row = self.connection.execute(
+                "SELECT version FROM countries WHERE short_name = ?",
+                (short_name,)).fetchone()
+            if expected_version is not None and (
+                    row is None or row[0] != expected_version):
+                raise models.StaleCountryError(
+                    "%s was changed by someone else after it was loaded" %
+                    short_name)
+            if row is not None and pieces is None and self._unchanged(country):
+                return row[0], False
+            self.connection.execute(
+                "INSERT INTO countries (short_name, long_name) VALUES (?, ?) "
+                "ON CONFLICT (short_name) DO UPDATE SET "
+                "long_name = excluded.long_name, version = version + 1",
+                (short_name, country.long_name))
+            self.connection.execute(
+                "DELETE FROM denominations WHERE country = ?", (short_name,))
+            self.connection.execute(
+                "DELETE FROM pieces WHERE country = ?", (short_name,))
+            self.connection.executemany(
+                "INSERT INTO denominations VALUES (?, ?, ?, ?, ?, ?, ?)",
+                ((short_name, position, denom.name, denom.code,
+                  json.dumps(list(denom.subunits)),
+                  json.dumps(denom.to_dict()['divisions']),
+                  int(denom.obsolete))
+                 for position, denom in enumerate(country.denominations)))
+            self._insert_pieces(country, country.inventory
+                                if pieces is None else pieces)
+            return self.connection.execute(
+                "SELECT version FROM countries WHERE short_name = ?",
+                (short_name,)).fetchone()[0], True
+
+    def _unchanged(self, country):
+        """ Whether the database already holds exactly this country.  Call
+        with the lock held.
+        """
+        stored = self._load_where_locked("WHERE short_name = ?",
+                                         (country.short_name,), True)
+        return bool(stored) and stored[0].serialize() == country.serialize()
+
+    def append_pieces(self, short_name, pieces):
+        """ Add pieces to a country that's already in the database
+
+        Like `models.Country.append_to_journal`, the caller is responsible for
+        validating the pieces.  Only the country's denominations are read,
+        so this costs the same however many pieces it already has.
+        """
+        with self.lock:
+            country = self.load(short_name, pieces=False)
+            if country is None:
+                raise KeyError(short_name)
+            with self.connection:
+                self._insert_pieces(country, pieces)
+                self.connection.execute(
+                    "UPDATE countries SET version = version + 1 "
+                    "WHERE short_name = ?", (short_name,))
+
+    def _insert_pieces(self, country, pieces):
+        codes = {denom.name: denom.code for denom in country.denominations}
+        self.connection.executemany(
+            "INSERT INTO pieces (country, code, %s) VALUES (?, ?, %s)" % (
+                ', '.join(PIECE_COLUMNS), ', '.join('?' * len(PIECE_COLUMNS))),
+            ((country.short_name, codes.get(piece.denomination, ''),
+              piece.piece_type, int(piece.obsolete), piece.denomination,
+              piece.value, piece.subunit, piece.year, piece.owner)
+             for piece in pieces))
+
+
+def _piece(row):
+    piece = models.CurrencyPiece(*row)
+    piece.obsolete = bool(piece.obsolete)
+    return piece
+
+
+def _validated(country, pieces):
+    for piece in pieces:
+        country.validate_piece(piece)
+        yield piece
+
+
+def parse_args(argv=None):
+    description = "Copy countries between the JSON data files and SQLite"
+    argparser = argparse.ArgumentParser(description=description)
+    argparser.add_argument("direction",
+                           choices=["import", "export"],
+                           help=("import copies the data files into the "
+                                 "database, export copies the database into "
+                                 "the data files."))
+    argparser.add_argument("countries",
+                           type=str,
+                           nargs='*',
+                           help="Countries to copy.  Defaults to all of them.")
+    argparser.add_argument("--database",
+                           type=str,
+                           default=constants.SQLITE_PATH,
+                           help=("Path to the database.  Defaults to "
+                                 "%(default)s"))
+    return argparser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    db = database(args.database)
+    if args.direction == "import":
+        for short_name in args.countries or models.Country.list_json():
+            # Stream the pieces, so that importing a huge country doesn't
+            # need it all in memory.  They have to come from the data file,
+            # even if the database is already the configured backend.
+            country, pieces = models.Country.stream_json(short_name)
+            country.validate()
+            db.save(country, _validated(country, pieces))
+            print("Imported {}".format(short_name))
+        return
+    for short_name in args.countries or db.list_all():
+        export(db, short_name)
+
+
+def export(db, short_name):
+    """ Write one country from the database over its JSON data file
+
+    The data file is written in the same canonical order as `models.Country`
+    saves it, and only if it changed.  A country with pieces waiting in its
+    journal isn't exported, because the journal would be thrown away.
+    """
+    import locks
+
+    with locks.country_lock(short_name):
+        if models.Country.has_journal(short_name):
+            print("Not exporting %s:  it has inserted pieces in its journal "
+                  "that the database doesn't.  Run compact.py and import it "
+                  "first." % short_name, file=sys.stderr)
+            sys.exit(1)
+        country = db.load(short_name)
+        if country is None:
+            print("Could not find country data for %s in %s" %
+                  (short_name, db.path), file=sys.stderr)
+            sys.exit(1)
+        country.validate()
+        written = country.write_json()
+    print("%s %s" % ("Exported" if written else "Unchanged", short_name))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,34 +2,64 @@
 """ Compute and print the total value of present currency for a country
 
 Since denominations often have subunits, we need a way to add these up
-correctly.  The ``total`` function in this module does that by calling the
-recursive function ``sum_units`` appropriately.  The ``sum_units`` function
-inspects a denomination's subunits, and adds up the total in the largest unit
-available.
+correctly.  Each `models.Denomination` knows the value of every one of its
+subunits in terms of its principal unit (its ``factors``), so the ``total``
+function in this module adds up the pieces in each subunit and converts those
+sums with one multiplication each.
 
 See the docstring for models.Denomination for documentation on the subunit
 data structure.
 """
 import argparse
-import copy
+from fractions import Fraction
 import os
 
 import constants
 import models
+import profiling
 
 
-def parse_args():
+def parse_args(argv=None):
     description = ("Print the total value of the currency that I have for a "
                    "country.")
     argparser = argparse.ArgumentParser(description=description)
-    argparser.add_argument("country", type=str, help="Country to sum.")
+    argparser.add_argument("country",
+                           type=str,
+                           nargs='?',
+                           default='',
+                           help="Country to sum.")
+    argparser.add_argument("--all",
+                           "-a",
+                           required=False,
+                           default=False,
+                           action="store_true",
+                           help="Print totals for every country.")
     argparser.add_argument("--verbose",
                            "-v",
                            required=False,
                            default=False,
                            action="store_true",
                            help="Print totals for all denominations.")
-    args = argparser.parse_args()
+    argparser.add_argument("--no-daemon",
+                           required=False,
+                           default=False,
+                           action="store_true",
+                           help="Don't ask a running server.py for totals.")
+    argparser.add_argument("--profile",
+                           required=False,
+                           default=False,
+                           action="store_true",
+                           help="Print where the time went when done.")
+    argparser.add_argument("--watch",
+                           "-w",
+                           required=False,
+                           default=False,
+                           action="store_true",
+                           help=("Keep running, and print a country's totals "
+                                 "again whenever they change."))
+    args = argparser.parse_args(argv)
+    if not args.country and not args.all:
+        argparser.error("either a country or --all is required")
 
     # Allow file paths
     args.country = os.path.basename(args.country)
@@ -38,13 +68,15 @@ def parse_args():
     return args
 
 
+@profiling.timed("sum_units")
 def sum_units(desired_unit, totals, divisions, divisor):
     """ Given a mapping of how a country's currency units are divided along
     with the totals of each currency unit and a desired unit, print out the
     sum of all the currency in the desired unit.
 
     See the docstring for `models.Denomination` for more info on the divisions
-    data structure.
+    data structure.  Unlike older versions of this function, neither `totals`
+    nor `divisions` is modified.
     """
     if len(divisions) == 0 and len(totals) == 0:
         return 0.0
@@ -52,37 +84,55 @@ def sum_units(desired_unit, totals, divisions, divisor):
         raise ValueError("Divisions is empty but totals is %s" % totals)
     elif len(totals) == 0:
         raise ValueError("Totals is empty but divisions is %s" % divisions)
-    breakdown = divisions.pop(desired_unit)
-    this_denomination = float(totals.pop(desired_unit)) / divisor
-    # Exit when we hit a denomination which is subdivided by one of itself
-    if desired_unit == breakdown['subunit']:
-        if breakdown['value'] == 1:
-            return this_denomination
-        else:
-            raise ValueError(
-                "Denomination '%s' is broken down into %s %s!" %
-                (desired_unit, breakdown['value'], breakdown['subunit']))
-    return this_denomination + sum_units(
-        breakdown['subunit'], totals, divisions, divisor * breakdown['value'])
+    factors = models.division_factors(divisions, desired_unit)
+    return to_principal(totals, factors) / divisor
+
 
+def to_principal(totals, factors):
+    """ Convert per-subunit totals into one total in the principal unit
 
-def total(country, denomination=None, count_obsolete=False):
+    :param totals:  A dict mapping subunits to the sum of pieces in them
+    :param factors:  A `models.Denomination`'s ``factors``
+    :returns:  The total as a float
+    """
+    principal_total = 0
+    for subunit, factor in factors.items():
+        subunit_total = totals[subunit]
+        if subunit_total:
+            principal_total += Fraction(subunit_total) * factor
+    return float(principal_total)
+
+
+@profiling.timed("total")
+def total(country, denomination=None, count_obsolete=False, pieces=None):
     """ Calculates the total value of a country's inventory of one denomination
 
     :param country:  A `Country`_ object
-    :param denomination:  The denomination that should be counted.  Defaults
-                          to the most recent denomination.
+    :param denomination:  The denomination (or its name) that should be
+                          counted.  Defaults to the most recent denomination.
     :param count_obsolete:  A boolean that indicates that only obsolete pieces
                             from the denomination should be counted If the
                             denomination is obsolete, this parameter will
                             default to True.
+    :param pieces:  The pieces to add up, if not the country's inventory.
+                    Pass the iterator from `models.Country.stream` to total a
+                    country in constant memory.
     :returns:  The total for this denomination of this country, in terms of
                the denomination's principal unit
     """
+    import inventory
+
+    if isinstance(denomination, str):
+        denomination = country.get_denomination(denomination)
     denomination = denomination or country.denominations[0]
     count_obsolete |= denomination.obsolete
     totals = {subunit: 0 for subunit in denomination.subunits}
-    for piece in country.inventory:
+    if pieces is None:
+        if isinstance(country.inventory, inventory.ColumnarInventory):
+            return _total_columns(country.inventory, denomination,
+                                  count_obsolete, totals)
+        pieces = country.inventory
+    for piece in pieces:
         if piece.denomination == denomination.name:
             if not piece.obsolete and denomination.obsolete:
                 print("WARN:  piece is not obsolete, but it's "
@@ -92,17 +142,94 @@ def total(country, denomination=None, count_obsolete=False):
             # the 2 fen Chinese bill that I have.  We'll skip counting those.
             if piece.obsolete == count_obsolete:
                 totals[piece.subunit] += piece.value
-    # The denomination's subunits should be ordered from largest to smallest
-    desired_unit = denomination.subunits[0]
-    divisions = copy.deepcopy(denomination.divisions)
-    return sum_units(desired_unit, totals, divisions, 1)
+    return to_principal(totals, denomination.factors)
+
+
+def _total_columns(columns, denomination, count_obsolete, totals):
+    """ `total` for a `inventory.ColumnarInventory`, using its grouped sums
+    instead of looking at each piece.
+    """
+    for (denom_name, obsolete, subunit), value_sum in columns.sums().items():
+        if denom_name != denomination.name:
+            continue
+        if not obsolete and denomination.obsolete:
+            for piece in columns.iter_group(denom_name, obsolete):
+                print("WARN:  piece is not obsolete, but it's "
+                      "denomination is:\n%s" % piece.to_dict())
+        if obsolete == count_obsolete:
+            totals[subunit] += value_sum
+    return to_principal(totals, denomination.factors)
+
+
+def _subunit_sums(country):
+    """ Add up a country's whole inventory in one pass
+
+    :returns:  A dict mapping (denomination name, obsolete, subunit) to the
+               sum of the values of the pieces in that group
+    """
+    import inventory
+
+    if isinstance(country.inventory, inventory.ColumnarInventory):
+        return country.inventory.sums()
+    sums = {}
+    for piece in country.inventory:
+        key = (piece.denomination, piece.obsolete, piece.subunit)
+        sums[key] = sums.get(key, 0) + piece.value
+    return sums
+
+
+@profiling.timed("total_all")
+def total_all(countries):
+    """ Calculates every total for every country, looking at each piece once
+
+    This gives the same numbers as calling `total` for every combination of
+    country, denomination and obsolete flag, but costs one pass over each
+    inventory instead of one pass per combination.  Use `lookup_total` to
+    read the result.
+
+    :param countries:  An iterable of `Country`_ objects
+    :returns:  A dict mapping (country short name, denomination name,
+               obsolete) to the total, in terms of the denomination's
+               principal unit
+    """
+    totals = {}
+    for country in countries:
+        sums = _subunit_sums(country)
+        for denomination in country.denominations:
+            for obsolete in (False, True):
+                subunit_totals = {subunit: sums.get(
+                    (denomination.name, obsolete, subunit), 0)
+                                  for subunit in denomination.subunits}
+                totals[(country.short_name, denomination.name, obsolete)] = (
+                    to_principal(subunit_totals, denomination.factors))
+            if denomination.obsolete and any(
+                    key[:2] == (denomination.name, False) for key in sums):
+                for piece in country.inventory:
+                    if (piece.denomination == denomination.name and
+                            not piece.obsolete):
+                        print("WARN:  piece is not obsolete, but it's "
+                              "denomination is:\n%s" % piece.to_dict())
+    return totals
 
 
-def _format_country(country, denomination=None, count_obsolete=False):
+def lookup_total(totals, country, denomination=None, count_obsolete=False):
+    """ Read one total out of the result of `total_all`
+
+    The arguments mean the same thing that they do for `total`.
+    """
+    if isinstance(denomination, str):
+        denomination = country.get_denomination(denomination)
+    denomination = denomination or country.denominations[0]
+    count_obsolete |= denomination.obsolete
+    return totals[(country.short_name, denomination.name, count_obsolete)]
+
+
+def _format_country(country, totals, denomination=None, count_obsolete=False):
     """ String format the total for one denomination of one country """
     denomination = denomination or country.denominations[0]
     out = "%(currency_total).2f %(denom_name)s"
-    currency_total = total(country, denomination, count_obsolete)
+    currency_total = lookup_total(totals, country, denomination,
+                                  count_obsolete)
     if denomination.obsolete or count_obsolete:
         out = "(obsolete) " + out
     if denomination.code:
@@ -113,30 +240,203 @@ def _format_country(country, denomination=None, count_obsolete=False):
     return out
 
 
-def format_country(country, verbose=False):
-    out = "%(name_long)s:  %(current_total)s %(eurozone_total)s"
-    current_total = _format_country(country)
-    # Currency from Eurozone countries is all obsolete, but I have Euros
-    if country.long_name in constants.EUROZONE_COUNTRIES:
-        eurozone = models.Country.load('eurozone')
-        eurozone_total = "[Eurozone:  %s]" % _format_country(eurozone)
-    else:
-        eurozone_total = ''
+def union_totals(short_name):
+    """ Return the `total_all` result for the country file of a shared
+    currency union, computing it at most once per process.
+    """
+    import cache
+
+    totals = cache.TOTALS.get(short_name)
+    if totals is None:
+        totals = total_all([models.Country.load_cached(short_name)])
+        cache.TOTALS.put(short_name, totals)
+    return totals
+
+
+def format_country(country, verbose=False, totals=None):
+    """ String format the totals for a country
+
+    :param totals:  The result of `total_all` for a list of countries that
+                    includes this one.  Computed if it isn't given.
+    """
+    if totals is None:
+        totals = total_all([country])
+
+    out = "%(name_long)s:  %(current_total)s %(union_totals)s"
+    current_total = _format_country(country, totals)
+    # Currency from Eurozone countries is all obsolete, but I have Euros.
+    # Other monetary unions work the same way.
+    unions = []
+    for union_name, union_short_name, members in (
+            constants.SHARED_CURRENCY_UNIONS):
+        if (country.long_name not in members or
+                union_short_name == country.short_name):
+            continue
+        union = models.Country.load_cached(union_short_name)
+        unions.append("[%s:  %s]" % (union_name, _format_country(
+            union, union_totals(union_short_name))))
     if verbose:
         if not country.denominations[0].obsolete:
-            if total(country, count_obsolete=True) != 0.00:
+            if lookup_total(totals, country, count_obsolete=True) != 0.00:
                 out += "\n    %s" % _format_country(country,
+                                                    totals,
                                                     count_obsolete=True)
         for denomination in country.denominations[1:]:
-            out += "\n    %s" % _format_country(country, denomination)
+            out += "\n    %s" % _format_country(country, totals, denomination)
     return out % dict(name_long=country.long_name,
                       current_total=current_total,
-                      eurozone_total=eurozone_total)
+                      union_totals=' '.join(unions))
+
+
+def location_headers():
+    """ Where this process reads the collection from, as HTTP headers
+
+    ``server.py`` sends these with every response, and `query_daemon` ignores
+    a daemon that doesn't send the same ones.
+    """
+    from urllib import parse
 
+    headers = {
+        'X-Currency-Backend': constants.STORAGE_BACKEND,
+        'X-Currency-Country-Dir': parse.quote(
+            os.path.abspath(constants.COUNTRY_DIR)),
+    }
+    if constants.STORAGE_BACKEND == 'sqlite':
+        headers['X-Currency-Sqlite-Path'] = parse.quote(
+            os.path.abspath(constants.SQLITE_PATH))
+    return headers
 
-def main():
-    args = parse_args()
-    country = models.Country.load(args.country)
+
+def daemon_port():
+    """ The port of the running server.py, or None if there isn't one
+
+    This only reads ``constants.DAEMON_FILE``, which is much cheaper than
+    importing an HTTP client and trying to connect.
+    """
+    try:
+        with open(constants.DAEMON_FILE, 'r') as daemon_file:
+            pid, port = daemon_file.read().split()
+        pid, port = int(pid), int(port)
+    except (OSError, ValueError):
+        return None
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        # Left behind by a daemon that was killed
+        return None
+    except PermissionError:
+        # Running as someone else
+        pass
+    return port
+
+
+def query_daemon(path, **params):
+    """ Ask a running server.py for something
+
+    :returns:  The decoded JSON response, or None if no daemon is running or
+               the one that is reads a different collection
+    :raises KeyError:  if the daemon doesn't know the country
+    """
+    port = daemon_port()
+    if port is None:
+        return None
+    # Only pay for the HTTP client when there's a daemon to ask
+    from http import client
+    import json
+    from urllib import parse
+
+    connection = client.HTTPConnection('127.0.0.1', port,
+                                       timeout=constants.DAEMON_TIMEOUT)
+    try:
+        connection.request('GET', "%s?%s" % (path, parse.urlencode(params)))
+        response = connection.getresponse()
+        body = json.loads(response.read().decode('utf-8'))
+    except (OSError, ValueError, client.HTTPException):
+        return None
+    finally:
+        connection.close()
+    expected = location_headers()
+    for header in ('X-Currency-Backend', 'X-Currency-Country-Dir',
+                   'X-Currency-Sqlite-Path'):
+        if response.getheader(header) != expected.get(header):
+            return None
+    if response.status != 200:
+        raise KeyError(body.get('error'))
+    return body
+
+
+def watch_totals(country=None, verbose=False):
+    """ Print totals, then print them again for each country that changes
+
+    Only the countries whose files changed are reloaded, and only the lines
+    that change are printed again.  Runs until interrupted.
+
+    :param country:  The short name of the one country to watch, or None for
+                     every country
+    """
+    # Only the watch loop needs these
+    import catalog as currency_catalog
+    import watch
+
+    current = currency_catalog.Catalog()
+    if country is not None and country not in current.countries:
+        print("Could not find country data for %s in %s" %
+              (country, constants.COUNTRY_DIR))
+        raise SystemExit(1)
+    watcher = watch.create_watcher()
+    printed = {}
+    try:
+        while True:
+            for short_name, each in sorted(current.countries.items(),
+                                           key=lambda c: c[1].long_name):
+                if country is not None and short_name != country:
+                    continue
+                # A country's line can change because of another country,
+                # e.g. the Eurozone, so every line is checked
+                text = format_country(each, verbose=verbose,
+                                      totals=current.totals)
+                if printed.get(short_name) != text:
+                    print(text, flush=True)
+                    printed[short_name] = text
+            current.reload(watch.wait_for_changes(watcher))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.profile:
+        profiling.enable()
+        # The daemon's time isn't ours to measure
+        args.no_daemon = True
+    if args.watch:
+        watch_totals(None if args.all else args.country, args.verbose)
+        return
+    if not args.no_daemon:
+        # If server.py is running, it already has everything in memory
+        params = dict(verbose='1' if args.verbose else '0')
+        if args.all:
+            params['all'] = '1'
+        else:
+            params['country'] = args.country
+        try:
+            response = query_daemon('/format', **params)
+        except KeyError:
+            response = None
+        if response is not None:
+            print(response['text'])
+            return
+    # Only the totals are needed, so ask for the columnar inventories
+    if args.all:
+        countries = models.Country.load_all(columnar=True)
+        totals = total_all(countries)
+        for country in sorted(countries, key=lambda c: c.long_name):
+            print(format_country(country, verbose=args.verbose,
+                                 totals=totals))
+        return
+    country = models.Country.load(args.country, columnar=True)
     print(format_country(country, verbose=args.verbose))
 
 
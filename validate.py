@@ -1,10 +1,25 @@
 #!/usr/bin/env python3
+""" Validate all country data
+
+Countries are only re-validated when their data file or journal has changed
+since they last validated cleanly.  The content hashes of clean files are kept
+in a manifest in the cache dir (see the ``cache`` module).  Use ``--all`` to
+ignore the manifest.
+"""
 import argparse
+import json
+import multiprocessing
+import os
+import sys
 
+import cache
 import models
+import profiling
+
+MANIFEST_NAME = "validated.json"
 
 
-def parse_args():
+def parse_args(argv=None):
     description = "Validate all country data"
     argparser = argparse.ArgumentParser(description=description)
     argparser.add_argument(
@@ -13,20 +28,135 @@ def parse_args():
         required=False,
         default=False,
         action="store_true",
-        help="Overwrite the current data file after validating")
+        help=("Overwrite the current data file after validating, if that "
+              "would change it"))
+    argparser.add_argument(
+        "--all",
+        "-a",
+        required=False,
+        default=False,
+        action="store_true",
+        help="Validate every country, even ones that haven't changed")
+    argparser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        required=False,
+        default=1,
+        help="Number of countries to validate in parallel")
+    argparser.add_argument(
+        "--profile",
+        required=False,
+        default=False,
+        action="store_true",
+        help=("Print where the time went when done.  Only covers this "
+              "process, so use it without --jobs."))
+
+    return argparser.parse_args(argv)
+
+
+def manifest_path():
+    return os.path.join(cache.catalog_dir(), MANIFEST_NAME)
+
+
+def read_manifest():
+    """ Read the manifest of countries that last validated cleanly
+
+    :returns:  A dict mapping short names to dicts with the content digest
+               that validated, and whether the data file was already in the
+               form that ``save`` writes (``canonical``).
+    """
+    try:
+        with open(manifest_path(), 'r') as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_manifest(manifest):
+    path = manifest_path()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=4, sort_keys=True)
+    except OSError:
+        pass
+
+
+def country_digest(short_name):
+    return models.Country.digest(short_name)
+
+
+def validate_country(short_name, overwrite=False):
+    """ Validate one country, and save it if asked to and if it would change
+
+    This runs in worker processes, so it reports problems instead of raising.
+
+    :returns:  A dict with the country's names, the digest of its files
+               after validation, whether it was written, and an error message
+               (or None)
+    """
+    result = dict(short_name=short_name, long_name=short_name, digest=None,
+                  written=False, error=None)
+    try:
+        if overwrite:
+            # Hold the country's lock from loading through saving, so that
+            # nobody else's changes are overwritten.  save() validates, and
+            # skips the write if nothing would change.
+            with models.Country.edit(short_name) as country:
+                result['long_name'] = country.long_name
+                before = models.Country.stamp(short_name)
+            result['written'] = models.Country.stamp(short_name) != before
+        else:
+            country = models.Country.load(short_name)
+            result['long_name'] = country.long_name
+            country.validate()
+        result['digest'] = country_digest(short_name)
+    except (AssertionError, KeyError, ValueError, OSError) as e:
+        result['error'] = "%s: %s" % (type(e).__name__, e)
+    return result
+
+
+def _validate_overwrite(short_name):
+    return validate_country(short_name, overwrite=True)
+
 
-    return argparser.parse_args()
+def main(argv=None):
+    args = parse_args(argv)
+    if args.profile:
+        profiling.enable()
+    manifest = {} if args.all else read_manifest()
 
+    to_validate = []
+    for short_name in sorted(models.Country.list_all()):
+        entry = manifest.get(short_name)
+        if (entry and entry['digest'] == country_digest(short_name) and
+                (entry['canonical'] or not args.overwrite)):
+            continue
+        to_validate.append(short_name)
 
-def main():
-    args = parse_args()
-    countries = models.Country.load_all()
+    worker = _validate_overwrite if args.overwrite else validate_country
+    if args.jobs > 1 and len(to_validate) > 1:
+        with multiprocessing.Pool(args.jobs) as pool:
+            results = pool.map(worker, to_validate)
+    else:
+        results = map(worker, to_validate)
 
-    for country in countries:
-        print("Validating {}".format(country.long_name))
-        country.validate()
-        if args.overwrite:
-            country.save()
+    failed = False
+    for result in results:
+        print("Validating {}".format(result['long_name']))
+        if result['error']:
+            print("    FAILED:  {}".format(result['error']))
+            manifest.pop(result['short_name'], None)
+            failed = True
+            continue
+        if result['written']:
+            print("    Rewrote {}".format(result['short_name']))
+        manifest[result['short_name']] = dict(digest=result['digest'],
+                                              canonical=args.overwrite)
+    write_manifest(manifest)
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+""" Value the whole collection in one currency, from local exchange rates
+
+`total.total` adds up each denomination in its own principal unit.  This
+module converts those totals into one reference currency (e.g. US dollars)
+using a table of historical exchange rates, without touching the network.
+
+Rates live in a CSV file (``constants.RATES_PATH``) with a header and one row
+per ISO-4217 code and date::
+
+    code,date,rate
+    CAD,2014-01-02,0.9404
+    CAD,2014-07-01,0.9371
+
+``rate`` is the value of one unit of ``code`` in the reference currency, so
+every row in the file must use the same reference currency.  When there's no
+rate for the exact date asked for, the rate with the nearest date is used.
+
+Obsolete denominations usually stop getting quoted once they're replaced.  A
+second CSV file (``constants.REDENOMINATIONS_PATH``) says what they were
+converted to::
+
+    old_code,new_code,ratio
+    ARP,ARA,0.001
+
+``ratio`` is how many units of ``new_code`` one unit of ``old_code`` became.
+A code without rates of its own is valued through its redenominations, as many
+steps as it takes to reach a code that has rates.
+
+`value_all` values every country in one pass:  it takes the batch totals from
+`total.total_all`, adds them up per code, and looks up one rate per code,
+rather than searching the rate table for every piece.
+"""
+import argparse
+import bisect
+import csv
+import datetime
+
+import constants
+import models
+import total
+
+
+class RateTable(object):
+    """ Exchange rates for many codes, indexed for nearest-date lookup """
+
+    def __init__(self, rates=(), redenominations=()):
+        """
+        :param rates:  An iterable of (code, ``datetime.date``, rate)
+        :param redenominations:  An iterable of (old code, new code, ratio)
+        """
+        by_code = {}
+        for code, date, rate in rates:
+            by_code.setdefault(code, []).append((date.toordinal(), rate))
+        # code -> sorted list of date ordinals, and the rates in the same order
+        self._dates = {}
+        self._rates = {}
+        for code, entries in by_code.items():
+            entries.sort()
+            self._dates[code] = [date for date, _ in entries]
+            self._rates[code] = [rate for _, rate in entries]
+        self.redenominations = {}
+        for old_code, new_code, ratio in redenominations:
+            self.redenominations[old_code] = (new_code, ratio)
+
+    @classmethod
+    def load(cls, rates_path=None, redenominations_path=None):
+        """ Read the rates and redenominations CSV files
+
+        A missing redenominations file just means there aren't any.
+        """
+        rates_path = rates_path or constants.RATES_PATH
+        redenominations_path = (redenominations_path or
+                                constants.REDENOMINATIONS_PATH)
+        rates = [(row['code'], datetime.date.fromisoformat(row['date']),
+                  float(row['rate']))
+                 for row in _read_csv(rates_path, ('code', 'date', 'rate'))]
+        try:
+            redenominations = [
+                (row['old_code'], row['new_code'], float(row['ratio']))
+                for row in _read_csv(redenominations_path,
+                                     ('old_code', 'new_code', 'ratio'))]
+        except FileNotFoundError:
+            redenominations = []
+        return cls(rates, redenominations)
+
+    def codes(self):
+        return set(self._dates)
+
+    def nearest_rate(self, code, date):
+        """ The rate for a code on the date nearest to `date`
+
+        :raises KeyError:  if there are no rates for the code
+        """
+        dates = self._dates[code]
+        target = date.toordinal()
+        i = bisect.bisect_left(dates, target)
+        if i == len(dates):
+            return self._rates[code][-1]
+        if i > 0 and target - dates[i - 1] <= dates[i] - target:
+            i -= 1
+        return self._rates[code][i]
+
+    def rate(self, code, date):
+        """ The value of one unit of a code, following redenominations
+
+        :raises KeyError:  if neither the code nor anything it was
+                           redenominated into has rates
+        """
+        ratio = 1.0
+        seen = set()
+        while code not in self._dates:
+            if code in seen or code not in self.redenominations:
+                raise KeyError(code)
+            seen.add(code)
+            code, step = self.redenominations[code]
+            ratio *= step
+        return ratio * self.nearest_rate(code, date)
+
+
+def _read_csv(path, fields):
+    with open(path, newline='') as csv_file:
+        reader = csv.DictReader(csv_file)
+        missing = set(fields) - set(reader.fieldnames or ())
+        if missing:
+            raise ValueError("%s is missing the column(s) %s" %
+                             (path, ', '.join(sorted(missing))))
+        return list(reader)
+
+
+def code_totals(countries, totals, count_obsolete=True):
+    """ Add up the `total.total_all` result per country and ISO-4217 code
+
+    :param count_obsolete:  Whether to include obsolete pieces
+    :returns:  A dict mapping each country's short name to a dict mapping
+               codes to totals.  Denominations without a code are under ''.
+    """
+    by_country = {}
+    for country in countries:
+        amounts = by_country.setdefault(country.short_name, {})
+        for denomination in country.denominations:
+            for obsolete in (False, True):
+                if obsolete and not count_obsolete:
+                    continue
+                amount = totals[(country.short_name, denomination.name,
+                                 obsolete)]
+                if amount:
+                    amounts[denomination.code] = (
+                        amounts.get(denomination.code, 0) + amount)
+    return by_country
+
+
+def value_all(countries, rates, date=None, count_obsolete=True):
+    """ Value every country in the reference currency of `rates`
+
+    :param countries:  A list of `models.Country`
+    :param rates:  A `RateTable`
+    :param date:  The ``datetime.date`` to value the collection on.
+                  Defaults to today.
+    :param count_obsolete:  Whether to include obsolete pieces
+    :returns:  A tuple of a dict mapping short names to values, and a dict
+               mapping (short name, code) to the amounts that couldn't be
+               valued because there's no rate for their code
+    """
+    date = date or datetime.date.today()
+    by_country = code_totals(countries, total.total_all(countries),
+                             count_obsolete)
+    code_rates = {}
+    values = {}
+    unvalued = {}
+    for short_name, amounts in by_country.items():
+        value = 0.0
+        for code, amount in amounts.items():
+            if code not in code_rates:
+                try:
+                    code_rates[code] = rates.rate(code, date)
+                except KeyError:
+                    code_rates[code] = None
+            if code_rates[code] is None:
+                unvalued[(short_name, code)] = amount
+            else:
+                value += amount * code_rates[code]
+        values[short_name] = value
+    return values, unvalued
+
+
+def parse_args(argv=None):
+    description = ("Value the collection in one currency using locally "
+                   "stored exchange rates.")
+    argparser = argparse.ArgumentParser(description=description)
+    argparser.add_argument("countries",
+                           type=str,
+                           nargs='*',
+                           help=("Countries to value.  Defaults to all of "
+                                 "them."))
+    argparser.add_argument("--date",
+                           type=datetime.date.fromisoformat,
+                           default=None,
+                           help="Value on this date (YYYY-MM-DD).  Defaults "
+                                "to today.")
+    argparser.add_argument("--rates",
+                           type=str,
+                           default=constants.RATES_PATH,
+                           help="Rates CSV.  Defaults to %(default)s")
+    argparser.add_argument("--redenominations",
+                           type=str,
+                           default=constants.REDENOMINATIONS_PATH,
+                           help="Redenominations CSV.  Defaults to "
+                                "%(default)s")
+    argparser.add_argument("--current",
+                           required=False,
+                           default=False,
+                           action="store_true",
+                           help="Leave out obsolete pieces.")
+    return argparser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        rates = RateTable.load(args.rates, args.redenominations)
+    except (OSError, ValueError) as e:
+        raise SystemExit("valuation.py: %s" % e)
+    # Only the totals are needed, so ask for the columnar inventories
+    if args.countries:
+        countries = [models.Country.load(c, columnar=True)
+                     for c in args.countries]
+    else:
+        countries = models.Country.load_all(columnar=True)
+    values, unvalued = value_all(countries, rates, args.date,
+                                 count_obsolete=not args.current)
+    long_names = {c.short_name: c.long_name for c in countries}
+    for short_name in sorted(values, key=long_names.get):
+        print("%s:  %.2f" % (long_names[short_name], values[short_name]))
+    print("Total:  %.2f" % sum(values.values()))
+    if unvalued:
+        print("\nNo rate for:")
+        for (short_name, code), amount in sorted(unvalued.items()):
+            print("    %s:  %.2f %s" % (long_names[short_name], amount,
+                                        code or "(no code)"))
+
+
+if __name__ == "__main__":
+    main()
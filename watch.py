@@ -0,0 +1,213 @@
+""" Watch the collection for changes
+
+`InotifyWatcher` asks the Linux kernel to report changes as they happen.
+`PollingWatcher` notices changes by comparing ``os.stat`` snapshots of the
+directory, so it works everywhere.  With the SQLite backend (see ``storage``)
+there are no data files to watch, so `DatabaseWatcher` polls the version of
+every country in the database instead.  `create_watcher` picks the best one
+that works here.  All of them have the same interface:  `wait` blocks until
+something changes (or a timeout passes) and returns the short names of the
+countries whose data changed.
+
+Saving a country touches its data file and its journal, and a bulk insert can
+save many countries in a row, so changes tend to come in bursts.
+`wait_for_changes` waits for a burst to end and returns it as one set.
+"""
+import os
+import select
+import struct
+import time
+
+import constants
+import storage
+
+# inotify(7) constants
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+_WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+               IN_CREATE | IN_DELETE)
+# struct inotify_event, without the name that follows it
+_EVENT = struct.Struct('iIII')
+
+
+def short_name_for(filename):
+    """ Map a file in the country data dir to the country it belongs to
+
+    :returns:  The country's short name, or None for unrelated files (like
+               editor swap files)
+    """
+    if filename.startswith('.') and filename.endswith('.journal'):
+        return filename[1:-len('.journal')]
+    if filename.startswith('.') or not filename.endswith('.json'):
+        return None
+    return filename[:-len('.json')]
+
+
+class PollingWatcher(object):
+    """ Detects changed countries by polling the data dir """
+
+    def __init__(self, directory=None):
+        self.directory = directory or constants.COUNTRY_DIR
+        self._snapshot = self._take_snapshot()
+
+    def _take_snapshot(self):
+        snapshot = {}
+        for filename in os.listdir(self.directory):
+            if short_name_for(filename) is None:
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                continue
+            snapshot[filename] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def changed_countries(self):
+        """ Return the short names of countries changed since the last call
+        """
+        snapshot = self._take_snapshot()
+        changed = set()
+        for filename in set(snapshot) | set(self._snapshot):
+            if snapshot.get(filename) != self._snapshot.get(filename):
+                changed.add(short_name_for(filename))
+        self._snapshot = snapshot
+        return changed
+
+    def wait(self, timeout=None, interval=1.0):
+        """ Poll every `interval` seconds until something changes
+
+        :param timeout:  Give up after this many seconds.  None waits
+                         forever.
+        :returns:  The short names of the changed countries, which is empty
+                   if it timed out
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            changed = self.changed_countries()
+            if changed:
+                return changed
+            if deadline is None:
+                time.sleep(interval)
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return changed
+            time.sleep(min(interval, remaining))
+
+    def close(self):
+        pass
+
+
+class DatabaseWatcher(PollingWatcher):
+    """ Detects changed countries by polling the database's versions """
+
+    def __init__(self, path=None):  # pylint: disable=W0231
+        self.path = path or constants.SQLITE_PATH
+        self._snapshot = self._take_snapshot()
+
+    def _take_snapshot(self):
+        return storage.database(self.path).versions()
+
+    def changed_countries(self):
+        snapshot = self._take_snapshot()
+        changed = set(short_name for short_name in
+                      set(snapshot) | set(self._snapshot)
+                      if snapshot.get(short_name) !=
+                      self._snapshot.get(short_name))
+        self._snapshot = snapshot
+        return changed
+
+
+class InotifyWatcher(object):
+    """ Detects changed countries with Linux's inotify, through ctypes
+
+    Raises OSError if inotify isn't available.
+    """
+
+    def __init__(self, directory=None):
+        import ctypes
+        import ctypes.util
+
+        self.directory = directory or constants.COUNTRY_DIR
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        try:
+            init = libc.inotify_init1
+            add_watch = libc.inotify_add_watch
+        except AttributeError:
+            raise OSError("inotify isn't available")
+        self.fd = init(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if add_watch(self.fd, os.fsencode(self.directory), _WATCH_MASK) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, "inotify_add_watch failed", self.directory)
+
+    def changed_countries(self):
+        """ Return the short names of countries changed since the last call
+        """
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(data):
+                _, _, _, name_length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = data[offset:offset + name_length].rstrip(b'\0')
+                offset += name_length
+                short_name = short_name_for(os.fsdecode(name))
+                if short_name is not None:
+                    changed.add(short_name)
+
+    def wait(self, timeout=None, interval=None):  # pylint: disable=W0613
+        """ Block until something changes.  See `PollingWatcher.wait`. """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = (None if deadline is None
+                         else max(0, deadline - time.monotonic()))
+            readable, _, _ = select.select([self.fd], [], [], remaining)
+            changed = self.changed_countries() if readable else set()
+            # Events for unrelated files don't count
+            if changed or not readable and deadline is not None:
+                return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def create_watcher(directory=None):
+    """ Return a `DatabaseWatcher` with the SQLite backend, an
+    `InotifyWatcher` if this platform has inotify, or else a `PollingWatcher`
+    """
+    if storage.enabled():
+        return DatabaseWatcher()
+    try:
+        return InotifyWatcher(directory)
+    except OSError:
+        return PollingWatcher(directory)
+
+
+def wait_for_changes(watcher, debounce=0.25, interval=1.0):
+    """ Block until countries change, and return them once the changes stop
+
+    :param debounce:  How many quiet seconds end a burst of changes
+    :param interval:  How often to poll, for a `PollingWatcher`
+    :returns:  The short names of every country changed during the burst
+    """
+    changed = watcher.wait(interval=interval)
+    while True:
+        more = watcher.wait(timeout=debounce, interval=min(interval,
+                                                           debounce))
+        if not more:
+            return changed
+        changed |= more